@@ -13,10 +13,21 @@ import socket
 import cgi
 import sys
 import zipfile
+import zlib
 import datetime
 import json
 import mimetypes
-import shelve
+import collections
+import threading
+import tempfile
+import time
+import Queue
+import StringIO
+import base64
+import csv
+import smtplib
+from email.mime.text import MIMEText
+from email.header import Header
 
 ### INITIALIZATION ###
 
@@ -26,6 +37,8 @@ urls = (                           # GET/POST
   "/logout", "Logout",             # Logout/-
   "/courses", "Courses",           # Results of a course search./-
   "/coursesJSON", "CoursesJSON",   # Top 10 courses in JSON/-
+  "/coursesAutocomplete", "CoursesAutocomplete",  # Course suggestions in JSON/-
+  "/tagsJSON", "TagsJSON",         # Most used tags in JSON/-
   "/register", "Register",         # Login and register form/Registration
   "/confirm", "SendConfirmation",  # Form for email address/Send conf. email
   "/confirm/(.*)", "Confirm",      # Page for confirming activation/Activation
@@ -36,14 +49,55 @@ urls = (                           # GET/POST
   "/delete/(\d+)", "Delete",       # Deleting a material/-
   "/materials", "Materials",       # Multiple materials/-
   "/materials/(\d+)", "Material",  # A material with comments/Add a comment
-  "/timezone", "SetTimezone"       # -/Set user timezone
+  "/materials/(\d+)/comments", "Comments",  # New comments in JSON/-
+  "/materialsJSON", "MaterialsJSON",         # Multiple materials in JSON/-
+  "/materialsJSON/(\d+)", "MaterialJSON",    # A material with comments in JSON/-
+  "/timezone", "SetTimezone",      # -/Set user timezone
+  "/stats", "Stats",               # Server statistics in JSON (admin)/-
+  "/metrics", "Metrics"            # Server metrics for Prometheus (admin)/-
 )
 
+TEMPLATE_DIRS = {0: "templates/reader", 1: "templates/user",
+                 2: "templates/admin"}
+RELOAD_TEMPLATES = False  # Set to True to pick up template edits while developing.
+
 UPLOAD_DIR = os.path.join(".", "uploads")
+BLOB_DIR = os.path.join(UPLOAD_DIR, "blobs")  # Files stored by their SHA-256.
+# Files stored by material id are spread over SHARD_DEPTH levels of
+# directories, named by SHARD_WIDTH digits of the id each:
+SHARD_DEPTH = 2
+SHARD_WIDTH = 2
 ALLOWED_FILETYPES = ["jpg", "jpeg", "png", "gif", "bmp", "zip", "pdf", "mpg",
                      "doc", "docx", "xls", "csv", "txt", "rtf", "html", "htm",
                      "xlsx", "ppt", "pptx", "odt", "mp3", "m4a", "ogg", "wav",
                      "mp4", "m4v", "wmv", "avi"]
+FACULTIES = ["HUM", "IT", "JSBE", "EDU", "SPORT", "SCIENCE", "YTK", "KIELI",
+             "MUU"]
+MATERIALS_PAGE = 30  # Materials per page in listings.
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+# Limits for the contents of uploaded zips, to catch zip bombs:
+ZIP_MAX_ENTRIES = 1000
+ZIP_MAX_SIZE = 200 * 1024 * 1024  # Total uncompressed bytes.
+ZIP_MAX_RATIO = 100  # Uncompressed size per compressed size of an entry.
+ZIP_MAX_DEPTH = 2  # Levels of zips within zips.
+ZIP_SCAN_WORKERS = 2
+UPLOAD_CHUNK = 64 * 1024  # Uploads are copied in chunks of this size.
+HOT_DECAY_INTERVAL = 600  # Seconds between recomputing decaying HOT scores.
+# Clients can wait up to LONG_POLL_TIMEOUT seconds for new comments. Waiting
+# holds a server thread, so at most LONG_POLL_WAITERS requests wait at once;
+# others are answered right away. Waiters check the database every
+# LONG_POLL_RECHECK seconds for comments added by other processes.
+LONG_POLL_TIMEOUT = 25
+LONG_POLL_WAITERS = 5
+LONG_POLL_RECHECK = 5
+
+# Downloads can be handed off to a front-end server: "X-Sendfile" (Apache,
+# lighttpd) or "X-Accel-Redirect" (nginx, which serves UPLOAD_DIR from the
+# internal location SENDFILE_PREFIX). Otherwise files are streamed in
+# DOWNLOAD_BUFFER sized blocks.
+SENDFILE_HEADER = None
+SENDFILE_PREFIX = "/protected/uploads"
+DOWNLOAD_BUFFER = 256 * 1024
 
 # App sends emails using a Gmail account:
 web.config.smtp_server = "smtp.gmail.com"
@@ -59,19 +113,29 @@ try:
 except IOError:
     sys.exit("You need a 'gmailpassword.txt' file with a password for the mail account")
 
-# Maximum file upload size:
-cgi.maxlen = 10 * 1024 * 1024
+# Maximum request size; the form fields take a little of it:
+cgi.maxlen = MAX_UPLOAD_SIZE + 64 * 1024
 
 app = web.application(urls, globals(), True)
 application = app.wsgifunc()
 db = models.DatabaseHandler()
 
+
+class Session(web.session.Session):
+    """web.py's session, which isn't saved at the end of requests that set
+    web.ctx.keep_session. Long polls set it, so that the session they loaded
+    doesn't overwrite a login or logout made while they waited."""
+
+    def _save(self):
+        if not web.ctx.get("keep_session"):
+            web.session.Session._save(self)
+
 # Every user will have a unique session object:
 if web.config.get("_session") is None:
     initializer = {"login": 0, "privilege": 0, "user": None,
                    "id": None, "timezone": None}
-    store = web.session.ShelfStore(shelve.open("sessions.shelf"))
-    session = web.session.Session(app, store, initializer)
+    store = models.SessionStore(db.db)
+    session = Session(app, store, initializer)
     web.config._session = session
 else:
     session = web.config._session
@@ -87,9 +151,26 @@ def logged():
 
 
 def create_path(id):
-    """Returns a file path based on given material id.
+    """Returns a file path based on given material id. The directories are
+    picked by the last digits of the id, so files spread evenly over
+    SHARD_DEPTH levels of directories however large the ids grow.
 
-    >>> create_path(13) == os.path.join(UPLOAD_DIR, "000", "013")
+    >>> create_path(13) == os.path.join(UPLOAD_DIR, "13", "00", "13")
+    True
+    >>> create_path(1234567) == os.path.join(UPLOAD_DIR, "67", "45", "1234567")
+    True
+    """
+    digits = str(id).zfill(SHARD_DEPTH * SHARD_WIDTH)
+    folders = [digits[len(digits) - (i + 1) * SHARD_WIDTH:][:SHARD_WIDTH]
+               for i in range(SHARD_DEPTH)]
+    return os.path.join(UPLOAD_DIR, *(folders + [str(id)]))
+
+
+def legacy_path(id):
+    """Returns a file path in the original layout, which only fits ids below
+    1000000.
+
+    >>> legacy_path(13) == os.path.join(UPLOAD_DIR, "000", "013")
     True
     """
     id = str(id)
@@ -99,12 +180,86 @@ def create_path(id):
 
 
 def is_valid_zip(path):
-    """Returns False if a zip file contains any disallowed filetypes."""
-    for content in zipfile.ZipFile(path).namelist():
-        content_type = content.split(".")[-1]
-        if content_type == content or not content_type in ALLOWED_FILETYPES:
-            return False
-    return True
+    """Returns False if a zip file contains any disallowed filetypes, or
+    exceeds the ZIP_MAX_* limits on entries, uncompressed size, compression
+    ratio or nesting. Zips within the zip are checked as well.
+
+    >>> f = StringIO.StringIO(); z = zipfile.ZipFile(f, "w", zipfile.ZIP_DEFLATED)
+    >>> z.writestr("notes.txt", "notes"); z.writestr("bomb.txt", "0" * 100000)
+    >>> z.close(); is_valid_zip(StringIO.StringIO(f.getvalue()))
+    False
+    """
+    return zip_size(path) is not None
+
+
+def zip_size(path, depth=1, limit=ZIP_MAX_SIZE):
+    """Returns the number of bytes a valid zip file and the zips within it
+    decompress to, or None if it's invalid or that's more than limit. Entry
+    sizes in a zip can't be trusted, so every entry is decompressed and the
+    bytes are counted. Zips within the zip are spooled to a temporary file.
+
+    >>> inner = StringIO.StringIO(); z = zipfile.ZipFile(inner, "w")
+    >>> z.writestr("notes.txt", "0" * 2000); z.close()
+    >>> f = StringIO.StringIO(); z = zipfile.ZipFile(f, "w")
+    >>> z.writestr("inner.zip", inner.getvalue()); z.close()
+    >>> zip_size(f) > 4000, zip_size(f, limit=3000)
+    (True, None)
+    """
+    try:
+        archive = zipfile.ZipFile(path)
+        entries = archive.infolist()
+        if len(entries) > ZIP_MAX_ENTRIES:
+            return None
+        total = 0
+        for entry in entries:
+            content_type = entry.filename.split(".")[-1]
+            if content_type == entry.filename or not content_type in ALLOWED_FILETYPES:
+                return None
+            if content_type == "zip" and depth >= ZIP_MAX_DEPTH:
+                return None
+            entry_limit = min(limit - total,
+                              ZIP_MAX_RATIO * max(entry.compress_size, 1))
+            if entry.file_size > entry_limit:
+                return None
+            nested = None
+            if content_type == "zip":
+                nested = tempfile.SpooledTemporaryFile(16 * UPLOAD_CHUNK)
+            try:
+                size = read_zip_entry(archive, entry, entry_limit, nested)
+                if size is None:
+                    return None
+                total += size
+                if nested:
+                    nested.seek(0)
+                    size = zip_size(nested, depth + 1, limit - total)
+                    if size is None:
+                        return None
+                    total += size
+            finally:
+                if nested:
+                    nested.close()
+        return total
+    except (zipfile.BadZipfile, zipfile.LargeZipFile, zlib.error, IOError,
+            RuntimeError, NotImplementedError):
+        return None  # Corrupt, encrypted or using an unknown compression.
+
+
+def read_zip_entry(archive, entry, limit, out=None):
+    """Decompresses a zip entry in UPLOAD_CHUNK sized reads, writing it to
+    out if given. Returns the number of bytes, or None as soon as there are
+    more than limit."""
+    size = 0
+    f = archive.open(entry)
+    try:
+        for buf in iter(lambda: f.read(UPLOAD_CHUNK), ""):
+            size += len(buf)
+            if size > limit:
+                return None
+            if out is not None:
+                out.write(buf)
+    finally:
+        f.close()
+    return size
 
 
 def delete_file(path):
@@ -114,7 +269,9 @@ def delete_file(path):
     False
     >>> delete_file("C:\\System32")
     False"""
-    regex = r"^((\\|/)\d{3}){2}\.\w{1,4}$"
+    sharded = r"((\\|/)\d{%d}){%d}(\\|/)\d+" % (SHARD_WIDTH, SHARD_DEPTH)
+    legacy = r"((\\|/)\d{3}){2}"
+    regex = r"^(%s|%s)\.\w{1,4}$" % (sharded, legacy)
     if not path.startswith(UPLOAD_DIR):
         return False
     if re.match(regex, path[len(UPLOAD_DIR):], re.IGNORECASE) == None:
@@ -126,25 +283,364 @@ def delete_file(path):
     return True
 
 
+class TemplateRegistry:
+    """Hands out render objects per (privilege, base) pair. Each render object
+    is created once per process and compiles each template on first use, so
+    requests don't pay for template lookup and compilation. In reload mode
+    the render objects are rebuilt whenever a template file changes."""
+
+    def __init__(self, dirs, globals, reload=False):
+        self.dirs = dirs
+        self.globals = globals
+        self.reload = reload
+        self.renders = {}
+        self.mtime = self._mtime() if reload else None
+
+    def _mtime(self):
+        """Returns the latest modification time of the template files."""
+        mtimes = [os.path.getmtime(os.path.join(d, name))
+                  for d in self.dirs.values() for name in os.listdir(d)]
+        return max(mtimes or [0])
+
+    def get(self, privilege, base=True):
+        if self.reload:
+            mtime = self._mtime()
+            if mtime != self.mtime:
+                self.mtime, self.renders = mtime, {}
+        key = (privilege, base)
+        if not key in self.renders:
+            self.renders[key] = web.template.render(self.dirs[privilege],
+                cache=True, base="base" if base else None, globals=self.globals)
+        return self.renders[key]
+
+
+def blob_path(sha256):
+    """Returns the path of a file stored by its SHA-256 hex digest.
+
+    >>> blob_path("ab" * 32) == os.path.join(BLOB_DIR, "ab", "ab", "ab" * 32)
+    True
+    """
+    return os.path.join(BLOB_DIR, sha256[:2], sha256[2:4], sha256)
+
+
+def material_path(material):
+    """Returns the path of a material's file; materials uploaded before the
+    blob store are stored by their id, in either directory layout."""
+    if material.sha256:
+        return blob_path(material.sha256)
+    path = create_path(material.id) + "." + material.type
+    # The file may still be in, or just moving from, the original layout:
+    for candidate in [path, legacy_path(material.id) + "." + material.type,
+                      path]:
+        if os.path.exists(candidate):
+            return candidate
+    return path
+
+
+def store_blob(temp_path, sha256):
+    """Moves a file into the blob store, or removes it if an identical file is
+    already stored. Returns True if the file was moved."""
+    path = blob_path(sha256)
+    if os.path.exists(path):
+        os.remove(temp_path)
+        return False
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    os.rename(temp_path, path)
+    return True
+
+
+def delete_blob(sha256):
+    """Deletes a stored file, returns True if deleted successfully.
+
+    >>> delete_blob("../../something_important")
+    False
+    """
+    if re.match(r"^[0-9a-f]{64}$", sha256) == None:
+        return False
+    try:
+        os.remove(blob_path(sha256))
+    except OSError:
+        return False
+    return True
+
+
+def hash_file(path):
+    """Returns the size and SHA-256 hex digest of a file."""
+    sha256, size = hashlib.sha256(), 0
+    f = open(path, "rb")
+    try:
+        for buf in iter(lambda: f.read(UPLOAD_CHUNK), ""):
+            sha256.update(buf)
+            size += len(buf)
+    finally:
+        f.close()
+    return size, sha256.hexdigest()
+
+
+def save_upload(f, max_size=MAX_UPLOAD_SIZE):
+    """Copies an uploaded file into a temporary file in UPLOAD_DIR in fixed
+    size chunks, computing its size and SHA-256 on the way. Raises ValueError
+    as soon as the file grows past max_size. Returns the temporary file's
+    path, the size in bytes and the hex digest.
+
+    >>> import StringIO; path, size, sha256 = save_upload(StringIO.StringIO("abc"))
+    >>> size, sha256[:16], open(path).read()
+    (3, 'ba7816bf8f01cfea', 'abc')
+    >>> os.remove(path); save_upload(StringIO.StringIO("abc"), max_size=2)
+    Traceback (most recent call last):
+    ValueError: File is too large
+    """
+    if not os.path.exists(UPLOAD_DIR):
+        os.makedirs(UPLOAD_DIR)
+    fd, temp_path = tempfile.mkstemp(suffix=".part", dir=UPLOAD_DIR)
+    sha256, size = hashlib.sha256(), 0
+    try:
+        out = os.fdopen(fd, "wb")
+        try:
+            while True:
+                buf = f.read(UPLOAD_CHUNK)
+                if not buf:
+                    break
+                size += len(buf)
+                if size > max_size:
+                    raise ValueError("File is too large")
+                sha256.update(buf)
+                out.write(buf)
+        finally:
+            out.close()
+    except:
+        os.remove(temp_path)
+        raise
+    return temp_path, size, sha256.hexdigest()
+
+
+def encode_cursor(material):
+    """Returns an opaque cursor pointing past a material in a listing."""
+    return base64.urlsafe_b64encode(json.dumps([material.sort_key,
+        material.id]))
+
+
+def decode_cursor(cursor):
+    """Returns the (sort key, id) pair of a cursor, or None if it's invalid.
+
+    >>> decode_cursor(encode_cursor(web.Storage(sort_key="2013-01-01", id=3)))
+    (u'2013-01-01', 3)
+    >>> decode_cursor("garbage")
+    """
+    try:
+        sort_key, id = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return sort_key, int(id)
+    except (TypeError, ValueError):
+        return None
+
+
+def normalize_course(code, title):
+    """Returns a course code and title the way courses are stored.
+
+    >>> normalize_course(u" tiea201 ", u"ohjelmointi   1")
+    (u'TIEA201', u'Ohjelmointi 1')
+    """
+    title = re.sub(" +", " ", title.strip().capitalize())
+    return code.strip().upper(), title
+
+
+def course_error(code, title, faculty):
+    """Returns an error message if a normalized course isn't valid, otherwise
+    None.
+
+    >>> course_error(u"TIEA201", u"Ohjelmointi 1", "IT")
+    >>> course_error(u"TIEA2", u"Ohjelmointi 1", "IT")
+    'Kurssikoodi ei ole sallitussa muodossa.'
+    """
+    # First check for empty fields:
+    if "" in [code, title]:
+        return "Lomake sisältää tyhjiä kenttiä."
+    elif re.match(r"^[A-Z0-9]{5}\d{2}$", code) == None:
+        return "Kurssikoodi ei ole sallitussa muodossa."
+    elif re.match(r"^.{1,50}$", title) == None:  # TODO parempi regex?
+        return "Kurssin nimi ei ole sallitussa muodossa."
+    elif not faculty in FACULTIES:
+        return "Valitse kurssin organisaatio."
+    return None
+
+
+def material_filters():
+    """Returns get_materials arguments for a page of the materials listing
+    that the query, key, user_id, course_id, tag and cursor parameters ask
+    for, or None if none of them do."""
+    sorts = {"NEW": "materials.date_added desc",
+             "HOT": "materials.hot desc",
+             "TOP": "materials.points desc"}
+
+    i = web.input(query="", key="", user_id="", course_id="", tag="",
+                  cursor="")
+    filters = {"order_by": "materials.id desc", "limit": MATERIALS_PAGE,
+               "after": decode_cursor(i.cursor)}
+
+    if i.query:
+        filters.update(search=i.query, order_by=None)
+    elif i.key in sorts:
+        filters.update(order_by=sorts[i.key])
+    elif i.key in FACULTIES:
+        filters.update(faculty=i.key)
+    elif i.user_id:
+        filters.update(user_id=i.user_id)
+    elif i.course_id:
+        filters.update(course_id=i.course_id)
+    elif i.tag:
+        filters.update(tag=i.tag)
+    else:
+        return None
+    return filters
+
+
+def cursor_for(material):
+    """Returns the cursor pointing past a material, or None if the listing
+    isn't paged by cursor. Search results are paged by their rank."""
+    return encode_cursor(material) if "sort_key" in material else None
+
+
+def next_cursor(materials):
+    """Returns the cursor of the page after a full page of materials, or
+    None if it was the last one."""
+    if len(materials) == MATERIALS_PAGE:
+        return cursor_for(materials[-1])
+    return None
+
+
+def json_fields():
+    """Returns the id and the material fields listed in the comma separated
+    fields parameter, or None if it's not given."""
+    fields = [f.strip() for f in web.input(fields="").fields.split(",")]
+    fields = [f for f in fields if f and f != "id"]
+    return ["id"] + fields if fields else None
+
+
+def json_row(row, fields=None):
+    """Serializes the given fields of a row, or all of its public ones.
+
+    >>> json_row(web.Storage(id=1, title=u"Tentti", sha256="ab"))
+    '{"id": 1, "title": "Tentti"}'
+    >>> json_row(web.Storage(id=1, title=u"Tentti"), ["id"])
+    '{"id": 1}'
+    """
+    fields = fields or [f for f in sorted(row) if f in models.MATERIAL_FIELDS]
+    return json.dumps(collections.OrderedDict((f, row[f]) for f in fields))
+
+
+def stream_materials(materials, fields=None):
+    """Yields a JSON object with a list of materials and the cursor of the
+    next page piece by piece, serializing each row as it's read."""
+    yield '{"materials": ['
+    count, last = 0, None
+    for material in materials:
+        yield (", " if count else "") + json_row(material, fields)
+        count, last = count + 1, material
+    cursor = cursor_for(last) if count == MATERIALS_PAGE else None
+    yield '], "next_cursor": %s}' % json.dumps(cursor)
+
+
+def parse_range(header, size):
+    """Parses a Range header with a single byte range into inclusive (start,
+    end) offsets. Returns None if there's no usable header, raises ValueError
+    if the range can't be satisfied.
+
+    >>> parse_range("bytes=0-99", 1000), parse_range("bytes=900-", 1000)
+    ((0, 99), (900, 999))
+    >>> parse_range("bytes=-100", 1000), parse_range("bytes=990-2000", 1000)
+    ((900, 999), (990, 999))
+    >>> parse_range("bytes=0-1,5-6", 1000), parse_range(None, 1000)
+    (None, None)
+    >>> parse_range("bytes=1000-", 1000)
+    Traceback (most recent call last):
+    ValueError: Range not satisfiable
+    """
+    match = re.match(r"^bytes=(\d*)-(\d*)$", (header or "").strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if not first:  # Suffix range, i.e. the last n bytes.
+        start, end = max(size - int(last), 0), size - 1
+        if int(last) == 0:
+            raise ValueError("Range not satisfiable")
+    else:
+        start, end = int(first), min(int(last or size - 1), size - 1)
+        if last and int(last) < start:
+            return None
+    if start >= size:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+def read_file(path, offset, length):
+    """Yields a part of a file in DOWNLOAD_BUFFER sized blocks."""
+    f = open(path, "rb")
+    try:
+        f.seek(offset)
+        while length > 0:
+            buf = f.read(min(DOWNLOAD_BUFFER, length))
+            if not buf:
+                break
+            length -= len(buf)
+            yield buf
+    finally:
+        f.close()
+
+
+def serve_file(path, content_type=None):
+    """Serves a file with Content-Length, ETag and Last-Modified headers.
+    Answers conditional requests with 304 and byte range requests with 206.
+    With SENDFILE_HEADER set, the transfer is left to the front-end server."""
+    stat = os.stat(path)
+    mtime = datetime.datetime.utcfromtimestamp(int(stat.st_mtime))
+    etag = '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+    web.header("ETag", etag)
+    web.header("Last-Modified", web.httpdate(mtime))
+    web.header("Accept-Ranges", "bytes")
+    if content_type:
+        web.header("Content-Type", content_type)
+
+    env = web.ctx.env
+    if "HTTP_IF_NONE_MATCH" in env:
+        if etag in env["HTTP_IF_NONE_MATCH"] or env["HTTP_IF_NONE_MATCH"] == "*":
+            raise web.notmodified()
+    else:
+        since = web.parsehttpdate(env.get("HTTP_IF_MODIFIED_SINCE", ""))
+        if since and since >= mtime:
+            raise web.notmodified()
+
+    if SENDFILE_HEADER == "X-Sendfile":
+        web.header("X-Sendfile", os.path.abspath(path))
+        return ""
+    elif SENDFILE_HEADER:
+        location = path[len(UPLOAD_DIR):].replace(os.sep, "/")
+        web.header(SENDFILE_HEADER, SENDFILE_PREFIX + location)
+        return ""
+
+    start, end = 0, stat.st_size - 1
+    # Ranges only apply if the client's copy is still current:
+    if env.get("HTTP_IF_RANGE", etag) == etag:
+        try:
+            byte_range = parse_range(env.get("HTTP_RANGE"), stat.st_size)
+        except ValueError:
+            raise web.HTTPError("416 Requested Range Not Satisfiable",
+                {"Content-Range": "bytes */%d" % stat.st_size}, "")
+        if byte_range:
+            start, end = byte_range
+            web.ctx.status = "206 Partial Content"
+            web.header("Content-Range", "bytes %d-%d/%d" %
+                (start, end, stat.st_size))
+    web.header("Content-Length", str(end - start + 1))
+    return read_file(path, start, end - start + 1)
+
+
 def create_render(privilege, base=True):
     """Create a render object based on user's privilege; different privileges
     use different HTML templates."""
-    my_globals = {"session": session,
-                  "format_date": format_date,
-                  "format_size": format_size,
-                  "format_time": format_time,
-                  "csrf_token": csrf_token}
-    base = "base" if base else None
-    if logged():
-        if privilege == 0:
-            render = web.template.render("templates/reader", base=base, globals=my_globals)
-        elif privilege == 1:
-            render = web.template.render("templates/user", base=base, globals=my_globals)
-        elif privilege == 2:
-            render = web.template.render("templates/admin", base=base, globals=my_globals)
-    else:
-        render = web.template.render("templates/reader", base=base, globals=my_globals)
-    return render
+    if not logged() or not privilege in TEMPLATE_DIRS:
+        privilege = 0
+    return templates.get(privilege, base)
 
 
 def csrf_protected(f):
@@ -164,6 +660,426 @@ def csrf_protected(f):
     return decorated
 
 
+class ResponseCache:
+    """An LRU cache of rendered responses. Every write to materials, courses,
+    likes or comments bumps the generation counter, which invalidates all
+    entries. Given a database, the counter is the "responses" generation
+    stored in it, so that a write in one worker process invalidates the
+    caches of the others too. Entries are per process, so ETags include a
+    process token.
+
+    >>> cache = ResponseCache(max_size=2)
+    >>> cache.put("a", 0, "A"); cache.put("b", 0, "B"); cache.get("a", 0)
+    'A'
+    >>> cache.put("c", 0, "C"); cache.get("b", 0), cache.get("a", 0)
+    (None, 'A')
+    >>> cache.invalidate(); cache.put("d", 0, "D"); cache.get("a", 1), cache.get("d", 1)
+    (None, None)
+    >>> cache, other = ResponseCache(db), ResponseCache(db)
+    >>> cache.put("a", cache.generation(), "A"); other.invalidate()
+    >>> cache.get("a", cache.generation()) is None
+    True
+    """
+
+    def __init__(self, db=None, max_size=1000):
+        self.db = db
+        self.max_size = max_size
+        self.token = uuid.uuid4().hex[:8]
+        self.local_generation = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def generation(self):
+        """Returns the current generation."""
+        if self.db is not None:
+            return self.db.get_generation("responses")
+        return self.local_generation
+
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] != generation:
+                return None
+            self.entries[key] = entry  # Mark as most recently used.
+            return entry[1]
+
+    def put(self, key, generation, value):
+        """Stores a response rendered in the given generation, unless a write
+        has happened since."""
+        current = self.generation()
+        with self.lock:
+            if generation != current:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (generation, value)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        with self.lock:
+            self.local_generation += 1
+            self.entries.clear()
+        if self.db is not None:
+            self.db.bump_generation("responses")
+
+response_cache = ResponseCache(db)
+
+
+def cached_response(f):
+    """Serves a GET handler's response from the response cache, keyed by the
+    path, query string and the privilege of the user. Sets an ETag and
+    answers conditional requests with 304 Not Modified."""
+    def decorated(*args, **kws):
+        key = (web.ctx.path, web.ctx.query, session.privilege if logged() else 0)
+        generation = response_cache.generation()
+        etag = '"%s-%d-%s"' % (response_cache.token, generation,
+            hashlib.md5(repr(key)).hexdigest()[:12])
+        web.header("ETag", etag)
+        web.header("Cache-Control", "private, no-cache")
+        if etag in web.ctx.env.get("HTTP_IF_NONE_MATCH", ""):
+            raise web.notmodified()
+
+        entry = response_cache.get(key, generation)
+        if entry is None:
+            headers = len(web.ctx.headers)
+            body = web.safestr(f(*args, **kws))
+            entry = (web.ctx.headers[headers:], body)
+            response_cache.put(key, generation, entry)
+        else:
+            for name, value in entry[0]:
+                web.header(name, value)
+        return entry[1]
+    return decorated
+
+
+def invalidates_cache(f):
+    """Invalidates the response cache after a handler that may change
+    materials, courses, likes or comments."""
+    def decorated(*args, **kws):
+        try:
+            return f(*args, **kws)
+        finally:
+            response_cache.invalidate()
+    return decorated
+
+
+def timed(route, f):
+    """Records the latency of a handler method in route_timings, by route,
+    HTTP method and response status."""
+    def decorated(*args, **kws):
+        start, status = time.time(), None
+        try:
+            return f(*args, **kws)
+        except web.HTTPError:
+            raise  # Sets web.ctx.status.
+        except Exception:
+            status = "500"
+            raise
+        finally:
+            status = status or web.ctx.get("status", "200 OK").split(" ", 1)[0]
+            route_timings.observe((route, web.ctx.method, status),
+                time.time() - start)
+    return decorated
+
+
+def prometheus_gauges(prefix, stats):
+    """Returns a dict of numbers as Prometheus gauges.
+
+    >>> print prometheus_gauges("zip", {"queue_depth": 2})
+    # TYPE zip_queue_depth gauge
+    zip_queue_depth 2
+    """
+    lines = []
+    for key, value in sorted(stats.items()):
+        lines.append("# TYPE %s_%s gauge" % (prefix, key))
+        lines.append("%s_%s %s" % (prefix, key, value))
+    return "\n".join(lines)
+
+route_timings = models.Timings()
+
+
+def remove_material(material):
+    """Deletes a material from the database and its file from the disk,
+    unless a concurrent request has already deleted it."""
+    if db.delete_material(material.id) != 1:
+        return
+    if material.sha256:
+        # The file is shared until its last material is deleted:
+        with db.transaction():
+            if db.release_blob(material.sha256):
+                delete_blob(material.sha256)
+    else:
+        delete_file(material_path(material))
+
+
+class ZipScanner:
+    """Checks uploaded zips with is_valid_zip in a bounded pool of worker
+    threads, so that uploads never wait for the check. A zip's material stays
+    pending until it has been scanned, and is removed if the zip is invalid."""
+
+    def __init__(self, workers=ZIP_SCAN_WORKERS, max_queued=100):
+        self.queue = Queue.Queue(max_queued)
+        self.latencies = collections.deque(maxlen=1000)
+        self.scanned = self.rejected = 0
+        self.workers = workers
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, material_id):
+        """Queues a pending material for scanning. Returns False if the queue
+        is full."""
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        try:
+            self.queue.put_nowait((time.time(), material_id))
+        except Queue.Full:
+            return False
+        return True
+
+    def resume(self):
+        """Queues materials left pending, e.g. by a restart."""
+        for material in db.select("materials", "id", pending=1):
+            self.submit(material.id)
+
+    def _work(self):
+        while True:
+            queued, material_id = self.queue.get()
+            try:
+                self.scan(material_id)
+            except Exception, e:
+                print "Scanning material %d failed:" % material_id, e
+            self.latencies.append(time.time() - queued)
+
+    def scan(self, material_id):
+        material = db.select("materials", id=material_id).list()
+        if not material or not material[0].pending:
+            return
+        material = material[0]
+        if is_valid_zip(material_path(material)):
+            db.update("materials", material.id, pending=0)
+        else:
+            remove_material(material)
+            self.rejected += 1
+        self.scanned += 1
+        response_cache.invalidate()
+
+    def stats(self):
+        """Returns the queue depth, scan counts and the latencies (seconds from
+        upload to a finished scan) of recent scans."""
+        latencies = sorted(self.latencies)
+        percentile = lambda p: latencies[int(p * (len(latencies) - 1))] \
+            if latencies else 0.0
+        return {"queue_depth": self.queue.qsize(),
+                "scanned": self.scanned,
+                "rejected": self.rejected,
+                "latency_p50": round(percentile(0.5), 3),
+                "latency_p95": round(percentile(0.95), 3),
+                "latency_max": round(percentile(1.0), 3)}
+
+zip_scanner = ZipScanner()
+zip_scanner.resume()
+
+
+class Mailer:
+    """Sends emails queued in the database from a background thread, reusing
+    one SMTP connection across messages. Failed messages are retried with
+    exponential backoff. The queue is in the app's database, unless another
+    DatabaseHandler is given.
+
+    >>> import smtpd, asyncore; received = []
+    >>> class Server(smtpd.SMTPServer):
+    ...     def process_message(self, peer, mailfrom, rcpttos, data):
+    ...         received.append((rcpttos, "Subject: =?utf-8?" in data))
+    >>> server = Server(("127.0.0.1", 0), None)
+    >>> loop = threading.Thread(target=asyncore.loop, kwargs={"timeout": 0.1})
+    >>> loop.daemon = True; loop.start()
+    >>> path = os.path.join(tempfile.mkdtemp(), "mail.db")
+    >>> queue = models.DatabaseHandler(path)
+    >>> port = server.socket.getsockname()[1]
+    >>> mailer = Mailer("127.0.0.1", port, database=queue)
+    >>> for address in ["a@b.fi", "c@d.fi"]:
+    ...     _ = queue.enqueue_mail("x@y.fi", address, u"Hei \\xe4", u"Viesti")
+    >>> mailer.run_once(); time.sleep(0.2); received
+    2
+    [(['a@b.fi'], True), (['c@d.fi'], True)]
+    >>> mailer.close(); server.close(); queue.counters.stop()
+    """
+    MAX_ATTEMPTS = 5
+    RETRY_DELAY = 30  # Seconds before the first retry, doubled for each retry.
+    LEASE = 300  # Seconds a claimed job is reserved for this worker.
+    POLL_INTERVAL = 5  # Seconds between checks for jobs of other processes.
+
+    def __init__(self, server, port, username=None, password=None,
+        starttls=False, database=None):
+        self.server, self.port = server, port
+        self.database = database
+        self.username, self.password = username, password
+        self.starttls = starttls
+        self.smtp = None
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def send(self, sender, recipient, subject, message):
+        """Queues an email and returns at once."""
+        self._db().enqueue_mail(sender, recipient, web.safeunicode(subject),
+            web.safeunicode(message))
+        self.start()
+        self.wakeup.set()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def resume(self):
+        """Starts the worker if emails were left in the queue."""
+        queued = self._db().select("mail_jobs", "id", status="queued", limit=1)
+        if queued.list():
+            self.start()
+
+    def _db(self):
+        return self.database or db
+
+    def _connect(self):
+        self.smtp = smtplib.SMTP(self.server, self.port, timeout=30)
+        if self.starttls:
+            self.smtp.ehlo()
+            self.smtp.starttls()
+            self.smtp.ehlo()
+        if self.username and self.password:
+            self.smtp.login(self.username, self.password)
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.smtp = None
+
+    def _send(self, job):
+        msg = MIMEText(job.message.encode("utf-8"), "plain", "utf-8")
+        msg["Subject"] = Header(job.subject, "utf-8")
+        msg["From"] = job.sender
+        msg["To"] = job.recipient
+        for retry in [True, False]:
+            if self.smtp is None:
+                self._connect()
+            try:
+                self.smtp.sendmail(job.sender, [job.recipient], msg.as_string())
+                return
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                # The server closed the connection, reconnect once:
+                self.smtp = None
+                if not retry:
+                    raise
+
+    def run_once(self):
+        """Sends the emails that are due, returns how many were tried."""
+        jobs = self._db().claim_mail_jobs(self.LEASE)
+        for job in jobs:
+            try:
+                self._send(job)
+                self._db().finish_mail_job(job.id)
+            except Exception, e:
+                self.close()
+                retry_at = None
+                if job.attempts < self.MAX_ATTEMPTS:
+                    delay = self.RETRY_DELAY * 2 ** (job.attempts - 1)
+                    retry_at = time.time() + delay
+                self._db().finish_mail_job(job.id, str(e), retry_at)
+        if not jobs:
+            self.close()  # Don't keep an idle connection open.
+        return len(jobs)
+
+    def _run(self):
+        while True:
+            try:
+                if self.run_once():
+                    continue
+            except Exception, e:
+                print "Sending email failed:", e
+            self.wakeup.wait(self.POLL_INTERVAL)
+            self.wakeup.clear()
+
+mailer = Mailer(web.config.smtp_server, web.config.smtp_port,
+    web.config.smtp_username, web.config.get("smtp_password"),
+    web.config.smtp_starttls)
+mailer.resume()
+
+
+class CommentNotifier:
+    """Wakes up requests waiting for new comments on a material. Waiters of
+    a material share one event, and there are at most max_waiters of them.
+
+    >>> notifier = CommentNotifier(max_waiters=1)
+    >>> threading.Timer(0.05, notifier.notify, [1]).start()
+    >>> notifier.wait(1, 5), notifier.wait(1, 0.01), notifier.waiters
+    (True, False, 0)
+    >>> notifier.events
+    {}
+    """
+
+    def __init__(self, max_waiters):
+        self.max_waiters = max_waiters
+        self.lock = threading.Lock()
+        # Material id -> [event set by the next comment, number of waiters]:
+        self.events = {}
+        self.waiters = 0
+
+    def wait(self, material_id, timeout):
+        """Blocks until a comment is added to the material or the timeout
+        passes. Returns True if a comment was added, False on timeout and
+        None right away if there are too many waiters already."""
+        with self.lock:
+            if self.waiters >= self.max_waiters:
+                return None
+            self.waiters += 1
+            entry = self.events.setdefault(material_id,
+                                           [threading.Event(), 0])
+            entry[1] += 1
+        try:
+            return entry[0].wait(timeout) or False
+        finally:
+            with self.lock:
+                self.waiters -= 1
+                entry[1] -= 1
+                if entry[1] == 0 and self.events.get(material_id) is entry:
+                    del self.events[material_id]
+
+    def notify(self, material_id):
+        """Wakes up the waiters of a material."""
+        with self.lock:
+            entry = self.events.pop(material_id, None)
+        if entry is not None:
+            entry[0].set()
+
+comment_notifier = CommentNotifier(LONG_POLL_WAITERS)
+
+
+def decay_hot_periodically():
+    """Lets the HOT scores of materials decay with age, every
+    HOT_DECAY_INTERVAL seconds. Runs in a daemon thread."""
+    while True:
+        time.sleep(HOT_DECAY_INTERVAL)
+        try:
+            if db.decay_hot():
+                response_cache.invalidate()
+        except Exception, e:
+            print "Decaying HOT scores failed:", e
+
+hot_decayer = threading.Thread(target=decay_hot_periodically)
+hot_decayer.daemon = True
+hot_decayer.start()
+
+
 ### TEMPLATE FUNCTIONS ###
 
 def csrf_token():
@@ -226,6 +1142,106 @@ def format_size(size):
     return size_str[:2] + "." + size_str[2] + "MB"
 
 
+templates = TemplateRegistry(TEMPLATE_DIRS, {"session": session,
+                                             "format_date": format_date,
+                                             "format_size": format_size,
+                                             "format_time": format_time,
+                                             "csrf_token": csrf_token},
+                             reload=RELOAD_TEMPLATES)
+
+
+def migrate_uploads():
+    """Moves files stored by material id into the blob store, removing
+    duplicates, and prints how much disk space was reclaimed. A file is
+    linked into the blob store before its material refers to the blob, and
+    only removed after that, so an interrupted run can be started again."""
+    materials = db.query("""SELECT id, type, sha256 FROM materials
+        WHERE sha256 IS NULL AND type IS NOT NULL""").list()
+    moved = duplicates = reclaimed = 0
+    for material in materials:
+        path = material_path(material)
+        if not os.path.exists(path):
+            continue
+        size, sha256 = hash_file(path)
+        blob = blob_path(sha256)
+        if os.path.exists(blob):
+            duplicates += 1
+            reclaimed += size
+        else:
+            if not os.path.exists(os.path.dirname(blob)):
+                os.makedirs(os.path.dirname(blob))
+            os.link(path, blob)
+            moved += 1
+        with db.transaction():
+            db.reference_blob(sha256, size)
+            db.update("materials", material.id, sha256=sha256)
+        os.remove(path)
+    print "Moved %d files, removed %d duplicates, reclaimed %.1f MB." % (
+        moved, duplicates, reclaimed / 1024.0 / 1024)
+
+
+def migrate_upload_layout(batch_size=100, pause=0.1):
+    """Moves files stored by material id from the original layout into the
+    sharded one, a batch at a time with a pause in between so that the site
+    stays responsive. Files can be read from either layout meanwhile."""
+    moved, last_id = 0, 0
+    while True:
+        batch = db.query("""SELECT id, type FROM materials WHERE id > $last_id
+            AND sha256 IS NULL AND type IS NOT NULL ORDER BY id
+            LIMIT $batch_size""", locals()).list()
+        if not batch:
+            break
+        for material in batch:
+            old = legacy_path(material.id) + "." + material.type
+            new = create_path(material.id) + "." + material.type
+            if os.path.exists(old) and not os.path.exists(new):
+                if not os.path.exists(os.path.dirname(new)):
+                    os.makedirs(os.path.dirname(new))
+                os.rename(old, new)
+                moved += 1
+        last_id = batch[-1].id
+        time.sleep(pause)
+    print "Moved %d files." % moved
+
+
+def import_courses(path, batch_size=1000):
+    """Imports a course catalog from a CSV file with code, title and faculty
+    columns, or from a file with a JSON object with those keys on each line.
+    Courses are checked like the course form checks them; invalid ones are
+    printed and skipped. Existing courses get the catalog's title and
+    faculty."""
+    def rows():
+        with open(path, "rb") as f:
+            if path.lower().endswith(".csv"):
+                for row in csv.DictReader(f):
+                    yield dict((key, (value or "").decode("utf-8"))
+                               for key, value in row.items() if key)
+            else:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+    skipped = [0]
+
+    def courses():
+        for n, row in enumerate(rows(), 1):
+            code, title = normalize_course(row.get("code") or u"",
+                                           row.get("title") or u"")
+            faculty = (row.get("faculty") or u"").strip().upper()
+            error = course_error(code, title, faculty)
+            if error:
+                skipped[0] += 1
+                print "Row %d (%s): %s" % (n, web.safestr(code), error)
+            else:
+                yield code, title, faculty
+
+    start = time.time()
+    inserted, updated = db.import_courses(courses(), batch_size)
+    response_cache.invalidate()
+    print "Inserted %d and updated %d courses, skipped %d, in %.1f s." % (
+        inserted, updated, skipped[0], time.time() - start)
+
+
 def doctest():
     """Run doctests."""
     import doctest
@@ -262,29 +1278,20 @@ class Logout:
 
 class Download():
     def GET(self, id):
-        """Serves a file."""
+        """Serves a file, supports byte ranges and conditional requests."""
         try:
             material = db.select("materials", id=int(id))[0]
         except IndexError:
             raise web.notfound()  # Material doesn't exist.
+        if material.pending:
+            raise web.notfound()  # Zip hasn't been checked yet.
 
-        path = create_path(id) + "." + material.type
+        path = material_path(material)
         if not os.path.exists(path):
             raise web.notfound()  # File doesn't exist.
-        try:
-            content_type = mimetypes.types_map["." + material.type]
-            web.header("Content-Type", content_type)
-        except KeyError:
-            pass  # Content type is unknown.
-
-        web.header("Transfer-Encoding", "chunked")
-        f = open(path, 'rb')
-        while 1:
-            buf = f.read(1024)  # Doesn't load the whole file into memory.
-            if not buf:
-                f.close()
-                break
-            yield buf
+        # Content type is None if unknown:
+        content_type = mimetypes.types_map.get("." + material.type)
+        return serve_file(path, content_type)
 
 
 class Upload:
@@ -301,88 +1308,83 @@ class Upload:
         return render.upload(course)
 
     @csrf_protected
+    @invalidates_cache
     def POST(self, id):
         """Validates material submission form, adds a new material entry and
         uploads the corresponding file. Returns an error message or an empty
         string if nothing went wrong."""
+        # Reject too large uploads before reading the request body:
+        if int(web.ctx.env.get("CONTENT_LENGTH") or 0) > cgi.maxlen:
+            return "Tiedoston maksimikoko on 10MB."
+        try:
+            # The file stays a FieldStorage, so it isn't read into memory:
+            i = web.input(myfile={}, title="", tags="", description="")
+        except ValueError:  # Request is too large.
+            return "Tiedoston maksimikoko on 10MB."
+
         course_id = int(id)
-        title = web.input().title.strip().capitalize()
-        tags = web.input().tags.strip().replace(",", " ").split()[:5]
+        title = i.title.strip().capitalize()
+        tags = i.tags.strip().replace(",", " ").split()[:5]
         tags = " ".join([tag for tag in tags if len(tag) < 20])
-        description = web.input().description.strip().capitalize()
+        description = i.description.strip().capitalize()
         if len(description) > 300:
             description = description[:300] + "..."
 
         if re.match(r"^.{4,40}$", title) == None:
             return "Materiaalin nimi ei ole annetussa muodossa."
 
-        # Insert material to database, use row id to generate file path:
-        material_id = db.insert("materials", title=title, description=description,
-            tags=tags, course_id=course_id, user_id=session.id)
+        file_to_upload = i.myfile
+        if not getattr(file_to_upload, "filename", None):
+            return "Lataaminen epäonnistui, yritä hetken kuluttua uudestaan."
+        filepath = file_to_upload.filename.replace("\\", "/")
+        filename = filepath.split("/")[-1]
+        filetype = filename.split(".")[-1]
 
-        # Create a path from id, eg. 11 becomes ".\\uploads\\000\\011"
-        path = create_path(material_id)
-        if not os.path.exists(os.path.dirname(path)):
-            os.makedirs(os.path.dirname(path))
+        # Check for illegal file types:
+        if not filetype in ALLOWED_FILETYPES or filetype == filename:
+            return "Tiedostotyyppi ei ole sallittu."
 
+        # Copy the file next to its final location:
         try:
-            x = web.input(myfile={})
-            if "myfile" in x:
-                file_to_upload = x["myfile"]
-                filepath = file_to_upload.filename.replace("\\", "/")
-                filename = filepath.split("/")[-1]
-                filetype = filename.split(".")[-1]
-                path += "." + filetype
-
-                # Check for illegal file types:
-                if not filetype in ALLOWED_FILETYPES or filetype == filename:
-                    db.delete("materials", id=material_id)
-                    return "Tiedostotyyppi ei ole sallittu."
-
-                # Upload file:
-                fout = open(path, "wb")
-                fout.write(file_to_upload.file.read())
-                fout.close()
-
-                # If file is zipped, check contents:
-                if filetype == "zip" and not is_valid_zip(path):
-                    db.delete("materials", id=material_id)
-                    delete_file(path)
-                    return "Zip-tiedosto sisältää ei sallittuja tiedostoja."
-
-                # Update file size and type to database:
-                size = os.path.getsize(path) / 1024
-                db.update("materials", material_id, type=filetype, size=size)
-            else:
-                db.delete("materials", id=material_id)
-                return "Lataaminen epäonnistui, yritä hetken kuluttua uudestaan."
-            return ""
+            temp_path, size, sha256 = save_upload(file_to_upload.file)
         except ValueError:  # File is too large.
-            db.delete("materials", id=material_id)
-            delete_file(path)
             return "Tiedoston maksimikoko on 10MB."
 
+        # Insert the material and store its file by hash; zips stay pending:
+        pending = 1 if filetype == "zip" else 0
+        try:
+            with db.transaction():
+                material_id = db.insert("materials", title=title,
+                    description=description, tags=tags, course_id=course_id,
+                    user_id=session.id, type=filetype, size=size / 1024,
+                    sha256=sha256, pending=pending)
+                db.add_material_tags(material_id, tags)
+                db.reference_blob(sha256, size)
+                store_blob(temp_path, sha256)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return "Lataaminen epäonnistui, yritä hetken kuluttua uudestaan."
+
+        if pending and not zip_scanner.submit(material_id):
+            remove_material(db.select("materials", id=material_id)[0])
+            return "Lataaminen epäonnistui, yritä hetken kuluttua uudestaan."
+        return ""
+
 
 class Like:
     @csrf_protected
+    @invalidates_cache
     def GET(self):
-        """'Likes' a material, i.e. inreases it's points by one and adds
-        the material's id to user's 'liked' column. Returns current points if
-        succeed, otherwise an empty string."""
-        id = web.input(id=None).id
-        if not id or session.privilege < 1:
-            return ""
-
-        user = db.select("users", id=session.id)[0]
-        material = db.select("materials", id=int(id))[0]
-        liked = db.select("users", id=session.id)[0].liked
-
-        # Don't like if user has already liked this material or owns the material:
-        if liked and id in liked.split(" ") or material.user_id == user.id:
+        """'Likes' a material, i.e. inreases it's points by one. A user can
+        like a material only once and not their own materials. Returns current
+        points if succeed, otherwise an empty string."""
+        id = web.input(id="").id
+        if not id.isdigit() or session.privilege < 1:
             return ""
 
         points = db.like_material(material_id=int(id), user_id=session.id)
-        return str(points)
+        return str(points) if points is not None else ""
 
 
 class Add:
@@ -397,36 +1399,27 @@ class Add:
         return render.choose_course()
 
     @csrf_protected
+    @invalidates_cache
     def POST(self):
         """Validates the course form, sends a JSON response which either has a
         redirect url or an error message. If form is valid, adds the course."""
-        code = web.input().code.strip().upper()
-        title = web.input().title.strip().capitalize()
-        title = re.sub(" +", " ", title)
+        code, title = normalize_course(web.input().code, web.input().title)
         faculty = web.input().faculty
         course = db.select("courses", code=code.upper()).list()
+        error = course_error(code, title, faculty)
         resp = ""
 
-        # First check for empty fields:
-        if "" in [code, title]:
-            resp = {"error": "Lomake sisältää tyhjiä kenttiä."}
-
-        # Then check if a course with the same code already exists:
-        elif course:
+        # Check if a course with the same code already exists:
+        if course and "" not in [code, title]:
             resp = {"redirect": "/add/" + str(course[0].id)}
 
-        # Finally check that submitted forms are valid:
-        elif re.match(r"^[A-Z0-9]{5}\d{2}$", code) == None:
-            resp = {"error": "Kurssikoodi ei ole sallitussa muodossa."}
-        elif re.match(r"^.{1,50}$", title) == None:  # TODO parempi regex?
-            resp = {"error": "Kurssin nimi ei ole sallitussa muodossa."}
-        elif not faculty in ["HUM", "IT", "JSBE", "EDU", "SPORT",
-                             "SCIENCE", "YTK", "KIELI", "MUU"]:
-            resp = {"error": "Valitse kurssin organisaatio."}
+        # Then check that submitted forms are valid:
+        elif error:
+            resp = {"error": error}
 
         # Information is valid, add course to database:
         else:
-            id = db.insert("courses", code=code, title=title, faculty=faculty)
+            id = db.add_course(code, title, faculty)
             resp = {"redirect": "/add/" + str(id)}
 
         web.header("Content-Type", "application/json")
@@ -474,7 +1467,7 @@ class SendConfirmation:
 
     @csrf_protected
     def POST(self):
-        """Sends confirmation email to given address."""
+        """Queues a confirmation email to given address."""
         email = web.input(email="").email
         user = db.select("users", id=session.id)[0]
 
@@ -488,9 +1481,10 @@ class SendConfirmation:
         subject = "Kurssimateriaalit - Aktivoi käyttäjätilisi"
         message = u"Aktivoi käyttäjätilisi '%s' osoitteessa %s" % (user.name, conf_url)
 
+        # The email is sent in the background:
         try:
-            web.sendmail(web.config.smtp_username, email, subject, message)
-        except:
+            mailer.send(web.config.smtp_username, email, subject, message)
+        except Exception:
             raise web.seeother("/confirm")
         raise web.seeother("/confirm?email_sent=1")
 
@@ -581,16 +1575,32 @@ class Courses:
         query = web.input(query="").query
         if not query:
             return render.course_results(None)
-        courses = db.search_courses(query).list()
+        courses = db.search_courses(query)
         return render.course_results(courses)
 
 
+class CoursesAutocomplete:
+    @csrf_protected
+    def GET(self):
+        """Returns JSON that contains the ids, codes and titles of the courses
+        whose code or title starts with the query. Doesn't touch the database."""
+        i = web.input(query="", limit="10")
+        limit = min(int(i.limit), 50) if i.limit.isdigit() else 10
+        obj = []
+        for c in db.search_courses(i.query, limit=limit):
+            obj.append({"id": c.id, "code": c.code, "title": c.title})
+
+        web.header("Content-Type", "application/json")
+        return json.dumps(obj)
+
+
 class CoursesJSON:
     @csrf_protected
+    @cached_response
     def GET(self):
         """Returns JSON that contains the ids and codes of the most popular
         courses, plus the amount of materials each one has."""
-        courses = db.get_courses(order_by="materials desc",
+        courses = db.get_courses(order_by="material_count desc",
             limit=10)
         obj = []
         for c in courses:
@@ -600,7 +1610,23 @@ class CoursesJSON:
         return json.dumps(obj)
 
 
+class TagsJSON:
+    @csrf_protected
+    @cached_response
+    def GET(self):
+        """Returns JSON with the most used tags, weighted by the amount of
+        materials each one has, ready for the jQCloud tag cloud."""
+        obj = []
+        for t in db.get_tags(limit=50):
+            obj.append({"text": t.tag, "weight": t.count, "link": "#",
+                        "html": {"class": "tag-link"}})
+
+        web.header("Content-Type", "application/json")
+        return json.dumps(obj)
+
+
 class Delete:
+    @invalidates_cache
     def GET(self, id):
         """Deletes a material and its corresponding file."""
         id = int(id)
@@ -612,45 +1638,47 @@ class Delete:
         if not (session.id == material.user_id or session.privilege == 2):
             raise web.notfound()
 
-        filetype = material.type
-        db.delete_material(id)
-        delete_file(create_path(id) + "." + filetype)
+        remove_material(material)
         raise web.seeother("/")
 
 
 class Materials:
     @csrf_protected
+    @cached_response
     def GET(self):
-        """Returns an html snippet containing materials in table rows."""
-        sorts = {"NEW": "materials.date_added desc",
-                 "HOT": "materials.comments desc",
-                 "TOP": "materials.points desc"}
-        faculties = ["HUM", "IT", "JSBE", "EDU", "SPORT",
-                     "SCIENCE", "YTK", "KIELI", "MUU"]
-
-        query = web.input(query="").query
-        key = web.input(key="").key
-        user_id = web.input(user_id="").user_id
-        course_id = web.input(course_id="").course_id
-
-        if query:
-            materials = db.get_materials(search=query, limit=30)
-        elif key:
-            if key in sorts:
-                materials = db.get_materials(order_by=sorts[key], limit=30)
-            elif key in faculties:
-                materials = db.get_materials(faculty=key, limit=30)
-        elif user_id:
-            materials = db.get_materials(user_id=user_id, limit=30)
-        elif course_id:
-            materials = db.get_materials(course_id=course_id, limit=30)
-        else:
-            materials = None
+        """Returns an html snippet containing a page of materials in table
+        rows. If there are more, the X-Next-Cursor header holds the cursor
+        parameter for the next page."""
+        filters = material_filters()
+        materials = list(db.get_materials(**filters)) if filters else None
+        if web.input(cursor="").cursor and not materials:
+            return ""  # No more pages.
+        cursor = next_cursor(materials)
+        if cursor:
+            web.header("X-Next-Cursor", cursor)
 
         render = create_render(session.privilege, base=False)
         return render.list_all(materials)
 
 
+class MaterialsJSON:
+    @csrf_protected
+    def GET(self):
+        """Streams JSON with a page of materials like /materials, and the
+        cursor of the next page or null. The fields parameter limits the
+        fields of each material, e.g. fields=title,points."""
+        filters = material_filters() or {"order_by": "materials.id desc",
+                                         "limit": MATERIALS_PAGE}
+        fields = json_fields()
+        try:
+            materials = db.get_materials(fields=fields, **filters)
+        except ValueError:
+            raise web.badrequest()
+
+        web.header("Content-Type", "application/json")
+        return stream_materials(materials, fields)
+
+
 class Material:
     @csrf_protected
     def GET(self, id):
@@ -664,6 +1692,7 @@ class Material:
         return render.list_single(material, comments)
 
     @csrf_protected
+    @invalidates_cache
     def POST(self, id):
         """Add a comment to a material. Returns an error message string if
         fails, otherwise an empty string."""
@@ -675,7 +1704,115 @@ class Material:
         if len(comment) > 300:
             return "Kommentin maksimipituus on 300 merkkiä"
         db.add_comment(comment, session.id, int(id))
+        comment_notifier.notify(int(id))
         return ""
 
-# if __name__ == "__main__":
+
+class Comments:
+    @csrf_protected
+    def GET(self, id):
+        """Returns JSON with a material's comments newer than the comment
+        whose id is given as since. If there are none and wait is given,
+        waits up to that many seconds (at most LONG_POLL_TIMEOUT) for one.
+        Doesn't save the session, which may change while waiting."""
+        web.ctx.keep_session = True
+        i = web.input(since="0", wait="0")
+        material_id = int(id)
+        since = int(i.since) if i.since.isdigit() else 0
+        wait = min(int(i.wait), LONG_POLL_TIMEOUT) if i.wait.isdigit() else 0
+
+        deadline = time.time() + wait
+        comments = db.get_comments(material_id, since=since).list()
+        while not comments and time.time() < deadline:
+            timeout = min(deadline - time.time(), LONG_POLL_RECHECK)
+            if comment_notifier.wait(material_id, timeout) is None:
+                break  # Too many waiters, the client polls again later.
+            comments = db.get_comments(material_id, since=since).list()
+
+        obj = []
+        for c in comments:
+            obj.append({"id": c.id, "user_id": c.user_id, "name": c.name,
+                        "content": c.content,
+                        "date_added": format_time(c.date_added)})
+        web.header("Content-Type", "application/json")
+        return json.dumps(obj)
+
+
+class MaterialJSON:
+    @csrf_protected
+    def GET(self, id):
+        """Streams JSON with a material, limited to the fields parameter like
+        /materialsJSON, and its comments."""
+        fields = json_fields()
+        try:
+            material = db.get_materials(id=int(id), fields=fields)[0]
+        except ValueError:
+            raise web.badrequest()
+        except IndexError:
+            raise web.notfound()
+        comments = db.get_comments(material_id=material.id)
+
+        web.header("Content-Type", "application/json")
+        return self.stream(material, fields, comments)
+
+    def stream(self, material, fields, comments):
+        """Yields the JSON response piece by piece."""
+        yield '{"material": %s, "comments": [' % json_row(material, fields)
+        for n, c in enumerate(comments):
+            yield (", " if n else "") + json.dumps(collections.OrderedDict([("id", c.id),
+                ("content", c.content), ("user_id", c.user_id),
+                ("name", c.name), ("date_added", c.date_added)]))
+        yield "]}"
+
+
+class Stats:
+    def GET(self):
+        """Returns JSON with statistics of the database connections, the row
+        cache and the zip scanner. Only for admins."""
+        if session.privilege != 2:
+            raise web.notfound()
+        web.header("Content-Type", "application/json")
+        return json.dumps({"connections": db.connection_stats(),
+                           "row_cache": db.row_cache_stats(),
+                           "zip_scanner": zip_scanner.stats()})
+
+class Metrics:
+    def GET(self):
+        """Returns request and query latencies, and the statistics of /stats,
+        in the Prometheus text format. Only for admins."""
+        if session.privilege != 2:
+            raise web.notfound()
+        web.header("Content-Type", "text/plain; version=0.0.4")
+        return "\n".join([
+            route_timings.prometheus("kurssit_request_seconds",
+                ["route", "method", "status"], "Time to handle a request."),
+            db.query_timings.prometheus("kurssit_query_seconds", ["query"],
+                "Time to execute a query."),
+            prometheus_gauges("kurssit_db", db.connection_stats()),
+            prometheus_gauges("kurssit_row_cache", db.row_cache_stats()),
+            prometheus_gauges("kurssit_zip_scanner", zip_scanner.stats())
+        ]) + "\n"
+
+
+# Time every handler:
+for route in urls[1::2]:
+    for method in ["GET", "POST"]:
+        if hasattr(globals()[route], method):
+            setattr(globals()[route], method,
+                    timed(route, getattr(globals()[route], method)))
+
+if __name__ == "__main__":
+    # Run "python app.py import catalog.csv" to import a course catalog:
+    if sys.argv[1:2] == ["import"] and len(sys.argv) == 3:
+        import_courses(sys.argv[2])
+        os._exit(0)  # The background workers would keep the process alive.
+    # Run "python app.py migrate-layout" to move uploads into the sharded
+    # directory layout:
+    if sys.argv[1:] == ["migrate-layout"]:
+        migrate_upload_layout()
+        os._exit(0)
+    # Run "python app.py migrate-uploads" to move uploads into the blob store:
+    if sys.argv[1:] == ["migrate-uploads"]:
+        migrate_uploads()
+        os._exit(0)
 #     app.run()
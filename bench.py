@@ -0,0 +1,463 @@
+# -*- coding:utf-8 -*-
+"""Performance benchmarks. Run from the project directory:
+
+    python bench.py templates
+    python bench.py load [--materials 200000 ...] [--output results.json]
+
+The load benchmark seeds a separate database (bench/kurssit.db by default),
+drives every route of the app through its WSGI application in-process and
+writes the latencies and throughput of each route as JSON.
+"""
+__author__ = "Aleksi Pekkala"
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import uuid
+import timeit
+import hashlib
+import argparse
+import datetime
+import threading
+import subprocess
+import StringIO
+import urllib
+import Cookie
+import web
+import app
+import models
+
+
+### SAMPLE DATA ###
+
+WORDS = [u"tentti", u"kysymykset", u"vastaukset", u"luentomonisteet",
+         u"harjoitukset", u"ratkaisut", u"muistiinpanot", u"kaavat",
+         u"tiivistelmä", u"demot", u"esseet", u"kalvot", u"ohjelmointi",
+         u"algoritmit", u"tilastotiede", u"kemia", u"fysiikka", u"talous",
+         u"psykologia", u"filosofia", u"historia", u"matematiikka"]
+FACULTIES = ["HUM", "IT", "JSBE", "EDU", "SPORT", "SCIENCE", "YTK", "KIELI",
+             "MUU"]
+# Every seeded material shares this file:
+SAMPLE_FILE = "%PDF-1.4\n" + "x" * 2800 + "\n%%EOF\n"
+PASSWORD = "bench"
+# Every tenth seeded user hasn't confirmed their account yet:
+PENDING_EVERY = 10
+
+
+def sample_material(id):
+    """Returns a material row like the ones get_materials returns."""
+    return web.Storage(id=id, title=u"Tenttikysymyksiä %d" % id,
+        description=u"Vanhoja tenttikysymyksiä vastauksineen.",
+        tags=u"tentti kysymykset vastaukset", points=id % 50,
+        date_added="2013-01-01", course_id=1, user_id=1, comments=id % 20,
+        size=2800, type="pdf", code=u"TIEA2011", course_title=u"Ohjelmointi 1",
+        faculty=u"IT", name=u"Käyttäjä", user_points=100)
+
+
+def sample_comment(id):
+    """Returns a comment row like the ones get_comments returns."""
+    return web.Storage(id=id, content=u"Kiitos, tästä oli apua!", user_id=1,
+        material_id=1, date_added="2013-01-01 12:00:00", name=u"Käyttäjä")
+
+
+def sample_words(rand, n):
+    return u" ".join(rand.choice(WORDS) for _ in range(n))
+
+
+def sample_registration():
+    """Returns a registration form with a name that isn't taken yet."""
+    return {"username": "B" + uuid.uuid4().hex[:15],
+            "password1": "Bench1234", "password2": "Bench1234"}
+
+
+def seed_database(path, courses=5000, materials=200000, comments=1000000,
+                  users=50000, seed=0):
+    """Creates a database at path filled with random courses, materials,
+    comments and users. User 1 is an admin, every PENDING_EVERY'th user is
+    waiting for confirmation and every user's password is PASSWORD. The same
+    seed gives the same data."""
+    rand = random.Random(seed)
+    models.DatabaseHandler(path).counters.stop()  # Creates the schema.
+    conn = models.connect(path)
+    today = datetime.date.today()
+
+    def day(max_days):
+        return str(today - datetime.timedelta(days=rand.randint(0, max_days)))
+
+    salt = "benchsalt"
+    hash = hashlib.sha256(PASSWORD + salt).hexdigest()
+    conn.executemany("""INSERT INTO users(id, name, hash, salt, conf_code,
+        privilege, date_joined, points) VALUES(?, ?, ?, ?, ?, ?, ?, ?)""",
+        ((id, "user%d" % id, hash, salt, "conf%d" % id,
+          2 if id == 1 else 0 if id % PENDING_EVERY == 0 else 1,
+          day(1500), rand.randint(0, 500)) for id in xrange(1, users + 1)))
+    conn.executemany("INSERT INTO courses(id, code, title, faculty) "
+        "VALUES(?, ?, ?, ?)",
+        ((id, "BNCH%d" % (id + 100000), sample_words(rand, 2).capitalize(),
+          rand.choice(FACULTIES)) for id in xrange(1, courses + 1)))
+
+    # Comments are spread unevenly, like attention is:
+    counts = [0] * (materials + 1)
+    material_ids = [int(rand.paretovariate(1.2)) % materials + 1
+                    for _ in xrange(comments)]
+    for id in material_ids:
+        counts[id] += 1
+    sha256 = hashlib.sha256(SAMPLE_FILE).hexdigest()
+    conn.executemany("""INSERT INTO materials(id, title, description, tags,
+        points, date_added, course_id, user_id, comments, size, type, sha256)
+        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        ((id, sample_words(rand, 3).capitalize(), sample_words(rand, 12),
+          sample_words(rand, 3), rand.randint(0, 100), day(1500),
+          rand.randint(1, courses), rand.randint(1, users), counts[id],
+          len(SAMPLE_FILE), "pdf", sha256) for id in xrange(1, materials + 1)))
+    # The tag index was backfilled when the schema was still empty:
+    models.copy_tags_to_material_tags(conn)
+    conn.execute("INSERT INTO blobs(sha256, size, refs) VALUES(?, ?, ?)",
+        (sha256, len(SAMPLE_FILE), materials))
+    conn.executemany("""INSERT INTO comments(content, user_id, material_id,
+        date_added) VALUES(?, ?, ?, ?)""",
+        ((sample_words(rand, 8), rand.randint(1, users), id,
+          day(1500) + " 12:00:00") for id in material_ids))
+    conn.execute("UPDATE materials SET hot=hot_score(points, comments, "
+        "date_added)")
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+### LOAD CLIENT ###
+
+class Client(object):
+    """Sends requests straight to a WSGI application and keeps the session
+    cookie, like a browser would."""
+
+    BOUNDARY = "----benchboundary"
+
+    def __init__(self, application):
+        self.application = application
+        self.cookies = {}
+
+    def multipart(self, data):
+        """Returns data as a multipart/form-data body."""
+        parts = []
+        for name, value in data.items():
+            if isinstance(value, tuple):
+                parts.append('Content-Disposition: form-data; name="%s"; '
+                    'filename="%s"\r\nContent-Type: application/octet-stream'
+                    '\r\n\r\n%s' % (name, value[0], value[1]))
+            else:
+                parts.append('Content-Disposition: form-data; name="%s"'
+                    '\r\n\r\n%s' % (name, value))
+        return "".join("--%s\r\n%s\r\n" % (self.BOUNDARY, part)
+                       for part in parts) + "--%s--\r\n" % self.BOUNDARY
+
+    def request(self, method, path, data=None):
+        """Returns the status code and body of a response. Data values that
+        are (filename, content) pairs are sent as file uploads."""
+        path, _, query = path.partition("?")
+        content_type = "application/x-www-form-urlencoded"
+        if data and any(isinstance(v, tuple) for v in data.values()):
+            content_type = "multipart/form-data; boundary=" + self.BOUNDARY
+            body = self.multipart(data)
+        else:
+            body = urllib.urlencode(data) if data else ""
+        env = {"REQUEST_METHOD": method, "PATH_INFO": path,
+               "QUERY_STRING": query, "SERVER_NAME": "localhost",
+               "SERVER_PORT": "80", "HTTP_HOST": "localhost",
+               "REMOTE_ADDR": "127.0.0.1", "wsgi.url_scheme": "http",
+               "wsgi.input": StringIO.StringIO(body),
+               "CONTENT_LENGTH": str(len(body)),
+               "CONTENT_TYPE": content_type,
+               "HTTP_X_REQUESTED_WITH": "XMLHttpRequest",
+               "HTTP_COOKIE": "; ".join("%s=%s" % c
+                                        for c in self.cookies.items())}
+        response = {}
+
+        def start_response(status, headers):
+            response["status"] = int(status.split()[0])
+            for name, value in headers:
+                if name.lower() == "set-cookie":
+                    for c in Cookie.SimpleCookie(value).values():
+                        self.cookies[c.key] = c.value
+
+        body = "".join(self.application(env, start_response))
+        return response["status"], body
+
+
+### BENCHMARKS ###
+
+def time_call(f, number):
+    """Returns the best average time of a call in milliseconds."""
+    return min(timeit.repeat(f, number=number, repeat=3)) / number * 1000
+
+
+def percentile(times, p):
+    """Returns the nearest-rank percentile of sorted times.
+
+    >>> percentile(range(1, 101), 95)
+    95
+    """
+    return times[max(int(math.ceil(p / 100.0 * len(times))) - 1, 0)]
+
+
+def benchmark_templates(number=100):
+    """Compares rendering the list_all and list_single snippets with a render
+    object created per request, as create_render used to do, and with the
+    cached render objects of the template registry."""
+    materials = [sample_material(i) for i in range(30)]
+    material = sample_material(1)
+    comments = [sample_comment(i) for i in range(100)]
+    app.session.timezone = app.session.id = None
+
+    def per_request():
+        return web.template.render(app.TEMPLATE_DIRS[1],
+            globals=app.templates.globals)
+
+    def registry():
+        return app.templates.get(1, base=False)
+
+    snippets = [
+        ("list_all", lambda render: render.list_all(materials)),
+        ("list_single", lambda render: render.list_single(material, comments))
+    ]
+    print "%-12s %12s %12s" % ("template", "before (ms)", "after (ms)")
+    for name, snippet in snippets:
+        before = time_call(lambda: unicode(snippet(per_request())), number)
+        after = time_call(lambda: unicode(snippet(registry())), number)
+        print "%-12s %12.3f %12.3f" % (name, before, after)
+
+
+def load_scenarios(volumes, rand):
+    """Returns (name, method, path, data, client) tuples for every route.
+    Path and data may be functions that return a random request each time.
+    Clients are logged in as an admin, or as a newly registered user waiting
+    for confirmation if named "pending", or not at all if "anonymous"."""
+    def material():
+        return rand.randint(1, volumes["materials"])
+
+    def course():
+        return rand.randint(1, volumes["courses"])
+
+    def user():
+        return rand.randint(1, volumes["users"])
+
+    def pending_user():
+        return PENDING_EVERY * rand.randint(1,
+            max(volumes["users"] // PENDING_EVERY, 1))
+
+    def word():
+        return rand.choice(WORDS)[:5].encode("utf-8")
+
+    def new_material():
+        return app.db.insert("materials", title="Poistettava", course_id=1,
+            user_id=1, size=len(SAMPLE_FILE), type="pdf")
+
+    def new_code():
+        return {"code": "B%04d%02d" % (rand.randint(0, 9999),
+            rand.randint(0, 99)), "title": "Uusi kurssi", "faculty": "IT"}
+
+    return [
+        ("GET /", "GET", "/", None, "admin"),
+        ("POST /login", "POST", "/login",
+            {"username": "user1", "password": PASSWORD}, "admin"),
+        ("GET /logout", "GET", "/logout", None, "anonymous"),
+        ("GET /courses", "GET", lambda: "/courses?query=" + word(), None,
+            "admin"),
+        ("GET /coursesJSON", "GET", "/coursesJSON", None, "admin"),
+        ("GET /coursesAutocomplete", "GET",
+            lambda: "/coursesAutocomplete?query=" + word(), None, "admin"),
+        ("GET /tagsJSON", "GET", "/tagsJSON", None, "admin"),
+        ("GET /register", "GET", "/register", None, "anonymous"),
+        ("POST /register", "POST", "/register", sample_registration,
+            "anonymous"),
+        ("GET /confirm", "GET", "/confirm", None, "pending"),
+        ("POST /confirm", "POST", "/confirm", {"email": "bench@example.com"},
+            "pending"),
+        ("GET /confirm/<code>", "GET",
+            lambda: "/confirm/conf%d" % pending_user(), None, "anonymous"),
+        ("POST /confirm/<code>", "POST",
+            lambda: "/confirm/conf%d" % pending_user(), None, "pending"),
+        ("GET /add", "GET", "/add", None, "admin"),
+        ("POST /add", "POST", "/add", new_code, "admin"),
+        ("GET /add/<id>", "GET", lambda: "/add/%d" % course(), None, "admin"),
+        ("POST /add/<id>", "POST", lambda: "/add/%d" % course(),
+            lambda: {"title": "Tenttikysymyksiä", "tags": "tentti",
+                     "description": "", "myfile": ("tentti.pdf", SAMPLE_FILE +
+                     str(rand.random()))}, "admin"),
+        ("GET /download/<id>", "GET", lambda: "/download/%d" % material(),
+            None, "admin"),
+        ("GET /like", "GET", lambda: "/like?id=%d" % material(), None,
+            "admin"),
+        ("GET /delete/<id>", "GET", lambda: "/delete/%d" % new_material(),
+            None, "admin"),
+        ("GET /materials?key=NEW", "GET", "/materials?key=NEW", None, "admin"),
+        ("GET /materials?key=HOT", "GET", "/materials?key=HOT", None, "admin"),
+        ("GET /materials?key=TOP", "GET", "/materials?key=TOP", None, "admin"),
+        ("GET /materials?key=<faculty>", "GET",
+            lambda: "/materials?key=" + rand.choice(FACULTIES), None, "admin"),
+        ("GET /materials?course_id", "GET",
+            lambda: "/materials?course_id=%d" % course(), None, "admin"),
+        ("GET /materials?user_id", "GET",
+            lambda: "/materials?user_id=%d" % user(), None, "admin"),
+        ("GET /materials?tag", "GET", lambda: "/materials?tag=" +
+            rand.choice(WORDS).encode("utf-8"), None, "admin"),
+        ("GET /materials?query", "GET", lambda: "/materials?query=" + word(),
+            None, "admin"),
+        ("GET /materials/<id>", "GET", lambda: "/materials/%d" % material(),
+            None, "admin"),
+        ("POST /materials/<id>", "POST", lambda: "/materials/%d" % material(),
+            {"comment": "Kiitos!"}, "admin"),
+        ("GET /materials/<id>/comments", "GET",
+            lambda: "/materials/%d/comments?since=1" % material(), None,
+            "admin"),
+        ("GET /materialsJSON", "GET",
+            "/materialsJSON?key=TOP&fields=title,points", None, "admin"),
+        ("GET /materialsJSON/<id>", "GET",
+            lambda: "/materialsJSON/%d" % material(), None, "admin"),
+        ("POST /timezone", "POST", "/timezone", {"offset": "-120"}, "admin"),
+        ("GET /stats", "GET", "/stats", None, "admin"),
+        ("GET /metrics", "GET", "/metrics", None, "admin"),
+    ]
+
+
+def run_scenario(clients, method, path, data, requests, concurrency):
+    """Sends requests over concurrent threads, returns the latencies in
+    milliseconds, the number of server errors and the elapsed seconds."""
+    times, errors = [], [0]
+    lock = threading.Lock()
+
+    def worker(n):
+        client = clients()
+        for _ in xrange(n):
+            with lock:  # The random generators aren't thread safe.
+                p = path() if callable(path) else path
+                d = data() if callable(data) else data
+            start = time.time()
+            status, _ = client.request(method, p, d)
+            elapsed = (time.time() - start) * 1000
+            with lock:
+                times.append(elapsed)
+                errors[0] += status >= 500
+
+    start = time.time()
+    threads = [threading.Thread(target=worker,
+        args=(requests // concurrency + (i < requests % concurrency),))
+        for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sorted(times), errors[0], time.time() - start
+
+
+def benchmark_load(args):
+    """Seeds a database unless it already exists, points the app at it and
+    times every route. Writes the results as JSON to args.output."""
+    web.config.debug = False  # Printing every query would skew the times.
+    volumes = {"courses": args.courses, "materials": args.materials,
+               "comments": args.comments, "users": args.users}
+    path = os.path.join(args.dir, "kurssit.db")
+    if not os.path.exists(args.dir):
+        os.makedirs(args.dir)
+    if args.reseed or not os.path.exists(path):
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        start = time.time()
+        seed_database(path, seed=args.seed, **volumes)
+        print >>sys.stderr, "Seeded %s in %.1fs" % (path, time.time() - start)
+
+    # Keep the app's database and files away from the real ones:
+    app.db.counters.stop()
+    app.db = models.DatabaseHandler(path)
+    app.session.store = models.SessionStore(app.db.db)
+    app.response_cache.db = app.db
+    app.mailer.start = lambda: None  # Leave the emails queued, unsent.
+    app.UPLOAD_DIR = os.path.join(args.dir, "uploads")
+    app.BLOB_DIR = os.path.join(app.UPLOAD_DIR, "blobs")
+    blob = app.blob_path(hashlib.sha256(SAMPLE_FILE).hexdigest())
+    if not os.path.exists(blob):
+        os.makedirs(os.path.dirname(blob))
+        with open(blob, "wb") as f:
+            f.write(SAMPLE_FILE)
+
+    def login():
+        client = Client(app.application)
+        client.request("POST", "/login",
+            {"username": "user1", "password": PASSWORD})
+        return client
+
+    def register():
+        client = Client(app.application)
+        client.request("POST", "/register", sample_registration())
+        return client
+
+    rand = random.Random(args.seed)
+    results = []
+    for name, method, p, data, client in load_scenarios(volumes, rand):
+        if args.routes and not any(r in name for r in args.routes):
+            continue
+        clients = {"admin": login, "pending": register}.get(client,
+            lambda: Client(app.application))
+        run_scenario(clients, method, p, data, args.warmup, 1)
+        times, errors, elapsed = run_scenario(clients, method, p, data,
+            args.requests, args.concurrency)
+        results.append({"route": name, "requests": len(times),
+            "errors": errors, "p50_ms": round(percentile(times, 50), 3),
+            "p95_ms": round(percentile(times, 95), 3),
+            "p99_ms": round(percentile(times, 99), 3),
+            "throughput_rps": round(len(times) / elapsed, 1)})
+        print >>sys.stderr, "%-32s %8.2f %8.2f %8.2f %9.1f" % (name,
+            results[-1]["p50_ms"], results[-1]["p95_ms"],
+            results[-1]["p99_ms"], results[-1]["throughput_rps"])
+    app.db.counters.stop()
+
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    report = {"commit": commit, "time": datetime.datetime.now().isoformat(),
+              "volumes": volumes, "requests": args.requests,
+              "concurrency": args.concurrency, "results": results}
+    out = open(args.output, "w") if args.output else sys.stdout
+    json.dump(report, out, indent=2, sort_keys=True,
+              separators=(",", ": "))
+    out.write("\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Performance benchmarks.")
+    commands = parser.add_subparsers(dest="benchmark")
+    commands.add_parser("templates", help="template rendering")
+    load = commands.add_parser("load", help="latency and throughput per route")
+    load.add_argument("--dir", default="bench",
+        help="directory of the seeded database and files")
+    load.add_argument("--reseed", action="store_true",
+        help="seed the database even if it exists")
+    load.add_argument("--seed", type=int, default=0)
+    load.add_argument("--courses", type=int, default=5000)
+    load.add_argument("--materials", type=int, default=200000)
+    load.add_argument("--comments", type=int, default=1000000)
+    load.add_argument("--users", type=int, default=50000)
+    load.add_argument("--requests", type=int, default=200,
+        help="timed requests per route")
+    load.add_argument("--warmup", type=int, default=10,
+        help="untimed requests per route first")
+    load.add_argument("--concurrency", type=int, default=1)
+    load.add_argument("--routes", nargs="*",
+        help="only routes whose name contains one of these")
+    load.add_argument("--output", help="JSON file, defaults to stdout")
+    args = parser.parse_args()
+
+    if args.benchmark == "templates":
+        benchmark_templates()
+    else:
+        benchmark_load(args)
+        # The app's worker threads would keep the process alive:
+        sys.stdout.flush()
+        os._exit(0)
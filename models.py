@@ -4,6 +4,983 @@ __author__ = "Aleksi Pekkala"
 
 import web
 import sqlite3
+import bisect
+import threading
+import atexit
+import time
+import re
+import collections
+import contextlib
+import datetime
+import itertools
+
+DATABASE = "kurssit.db"
+
+# Applied to every new connection. WAL lets readers run alongside a writer.
+PRAGMAS = ["PRAGMA journal_mode=WAL",
+           "PRAGMA synchronous=NORMAL",
+           "PRAGMA cache_size=-16000",      # 16MB page cache.
+           "PRAGMA mmap_size=268435456",    # 256MB memory map.
+           "PRAGMA foreign_keys=OFF"]
+BUSY_TIMEOUT = 10.0  # Seconds to wait for a locked database.
+# Upper bounds (seconds) of the latency histogram buckets:
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0]
+SLOW_QUERY = 0.25  # Queries slower than this (seconds) are printed.
+# Seconds between checks whether another process has changed the courses:
+CATALOG_CHECK_INTERVAL = 2.0
+# HOT scores are the points and weighted comments of a material, divided by
+# its age in hours (plus two) to the power of HOT_GRAVITY:
+HOT_GRAVITY = 1.8
+HOT_COMMENT_WEIGHT = 2
+# Scores that have decayed below this are left alone until the next like or
+# comment; such materials are too old to reach the HOT listing's first pages:
+HOT_FLOOR = 0.0001
+EPOCH = datetime.date(1970, 1, 1)
+
+# Fields of get_materials rows, and the columns they're selected from:
+MATERIAL_FIELDS = {"id": "materials.id", "title": "materials.title",
+    "description": "materials.description", "tags": "materials.tags",
+    "points": "materials.points", "date_added": "materials.date_added",
+    "course_id": "materials.course_id", "user_id": "materials.user_id",
+    "comments": "materials.comments", "size": "materials.size",
+    "type": "materials.type", "code": "courses.code",
+    "course_title": "courses.title", "faculty": "courses.faculty",
+    "name": "users.name", "user_points": "users.points"}
+
+# Tables whose rows select() serves from the row cache, and the columns rows
+# are looked up by (the primary key and unique or lookup keys):
+CACHED_KEYS = {"materials": ["id"], "courses": ["id", "code"],
+               "users": ["id", "name", "conf_code"]}
+# Rows of other tables that triggers update on a write, e.g. the material
+# count of a material's course: table -> [(other table, column of its id)].
+CACHE_DEPENDENTS = {"materials": [("courses", "course_id")]}
+ROW_CACHE_SIZE = 10000  # Cached lookups.
+ROW_CACHE_TTL = 60.0  # Seconds, bounds staleness from writes made elsewhere.
+
+# Keeps the full-text index in sync with a new or updated material row:
+FTS_INSERT = """INSERT INTO materials_fts(rowid, title, description, tags,
+                        code, course_title, faculty)
+                    VALUES(new.id, new.title, new.description, new.tags,
+                        (SELECT code FROM courses WHERE id=new.course_id),
+                        (SELECT title FROM courses WHERE id=new.course_id),
+                        (SELECT faculty FROM courses WHERE id=new.course_id));"""
+
+
+def hot_score(points, comments, date_added, now=None):
+    """Returns the HOT score of a material. Also available in SQL.
+
+    >>> round(hot_score(0, 0, "2013-01-01", now=1356998400), 6)  # At midnight.
+    0.287175
+    >>> hot_score(10, 20, "2013-01-01", now=1356998400 + 48 * 3600) < 0.2
+    True
+    """
+    now = time.time() if now is None else now
+    try:
+        added = (datetime.date(*map(int, date_added[:10].split("-"))) -
+                 EPOCH).days * 86400
+    except (TypeError, ValueError):
+        added = now  # Treat rows without a date as new.
+    hours = max(now - added, 0) / 3600.0
+    activity = 1 + (points or 0) + HOT_COMMENT_WEIGHT * (comments or 0)
+    return activity / (hours + 2) ** HOT_GRAVITY
+
+# Recomputes a material's HOT score after its points or comments change:
+HOT_UPDATE = """UPDATE materials SET hot=hot_score(points, comments,
+    date_added) WHERE id=?"""
+
+
+def rebuild_fts(conn):
+    """(Re)indexes all existing materials for full-text search."""
+    conn.execute("DELETE FROM materials_fts")
+    conn.execute("""INSERT INTO materials_fts(rowid, title, description, tags,
+        code, course_title, faculty)
+        SELECT materials.id, materials.title, description, tags, code,
+        courses.title, faculty FROM materials
+        LEFT JOIN courses ON course_id=courses.id""")
+
+
+def copy_liked_to_likes(conn):
+    """Copies the space-separated material ids of users.liked into the likes
+    table."""
+    rows = conn.execute("SELECT id, liked FROM users WHERE liked != ''")
+    likes = [(user_id, int(material_id)) for user_id, liked in rows.fetchall()
+             for material_id in liked.split() if material_id.isdigit()]
+    conn.executemany("""INSERT OR IGNORE INTO likes(user_id, material_id)
+        VALUES(?, ?)""", likes)
+
+
+def split_tags(tags):
+    """Returns the distinct tags of a space separated string, in lowercase.
+
+    >>> split_tags(u"Tentti kaavat tentti")
+    [u'kaavat', u'tentti']
+    """
+    return sorted(set(tag.lower() for tag in (tags or u"").split()))
+
+
+def copy_tags_to_material_tags(conn):
+    """Indexes the tags of existing materials in the material_tags table."""
+    rows = conn.execute("SELECT id, tags FROM materials WHERE tags != ''")
+    conn.executemany("""INSERT OR IGNORE INTO material_tags(material_id, tag)
+        VALUES(?, ?)""", ((id, tag) for id, tags in rows.fetchall()
+                          for tag in split_tags(tags)))
+
+
+# Schema changes applied on top of the base tables, in order. A step is either
+# an SQL script or a function that takes an sqlite3 connection. Never edit a
+# released step; append a new one instead.
+MIGRATIONS = [
+    (1, "Full-text search index for materials", """
+        CREATE VIRTUAL TABLE IF NOT EXISTS materials_fts USING fts5(
+            title, description, tags, code, course_title, faculty,
+            tokenize="unicode61 remove_diacritics 0"
+        );
+        CREATE TRIGGER IF NOT EXISTS materials_fts_insert
+        AFTER INSERT ON materials BEGIN
+            %(fts_insert)s
+        END;
+        CREATE TRIGGER IF NOT EXISTS materials_fts_update
+        AFTER UPDATE OF title, description, tags, course_id
+        ON materials BEGIN
+            DELETE FROM materials_fts WHERE rowid=old.id;
+            %(fts_insert)s
+        END;
+        CREATE TRIGGER IF NOT EXISTS materials_fts_delete
+        AFTER DELETE ON materials BEGIN
+            DELETE FROM materials_fts WHERE rowid=old.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS materials_fts_course_update
+        AFTER UPDATE OF code, title, faculty ON courses BEGIN
+            UPDATE materials_fts SET code=new.code,
+                course_title=new.title, faculty=new.faculty
+            WHERE rowid IN (SELECT id FROM materials WHERE course_id=new.id);
+        END;
+    """ % {"fts_insert": FTS_INSERT}),
+    (2, "Backfill the full-text search index", rebuild_fts),
+    (3, "Indexes for joins, filters and sorts", """
+        CREATE INDEX IF NOT EXISTS materials_course_id ON materials(course_id);
+        CREATE INDEX IF NOT EXISTS materials_user_id ON materials(user_id);
+        CREATE INDEX IF NOT EXISTS materials_date_added
+            ON materials(date_added);
+        CREATE INDEX IF NOT EXISTS materials_points ON materials(points);
+        CREATE INDEX IF NOT EXISTS comments_material_id
+            ON comments(material_id, date_added);
+        CREATE INDEX IF NOT EXISTS users_name ON users(name);
+        CREATE INDEX IF NOT EXISTS users_conf_code ON users(conf_code);
+        CREATE INDEX IF NOT EXISTS courses_code ON courses(code);
+        CREATE INDEX IF NOT EXISTS courses_faculty ON courses(faculty);
+    """),
+    (4, "Likes table", """
+        CREATE TABLE IF NOT EXISTS likes(
+            user_id      INTEGER,
+            material_id  INTEGER,
+            PRIMARY KEY (user_id, material_id)
+        );
+        CREATE INDEX IF NOT EXISTS likes_material_id ON likes(material_id);
+    """),
+    (5, "Move users.liked into the likes table", copy_liked_to_likes),
+    (6, "Sessions table", """
+        CREATE TABLE IF NOT EXISTS sessions(
+            session_id   TEXT PRIMARY KEY,
+            data         TEXT,
+            atime        REAL
+        );
+        CREATE INDEX IF NOT EXISTS sessions_atime ON sessions(atime);
+    """),
+    (7, "SHA-256 of uploaded files", """
+        ALTER TABLE materials ADD COLUMN sha256 TEXT;
+    """),
+    (8, "Reference counts of content-addressed files", """
+        CREATE TABLE IF NOT EXISTS blobs(
+            sha256       TEXT PRIMARY KEY,
+            size         INTEGER,
+            refs         INTEGER DEFAULT 0
+        );
+    """),
+    (9, "Pending state for materials waiting for a zip scan", """
+        ALTER TABLE materials ADD COLUMN pending INTEGER DEFAULT 0;
+    """),
+    (10, "Queue for outgoing email", """
+        CREATE TABLE IF NOT EXISTS mail_jobs(
+            id           INTEGER PRIMARY KEY,
+            sender       TEXT,
+            recipient    TEXT,
+            subject      TEXT,
+            message      TEXT,
+            status       TEXT DEFAULT 'queued',
+            attempts     INTEGER DEFAULT 0,
+            next_attempt REAL,
+            last_error   TEXT,
+            date_added   TEXT DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS mail_jobs_due
+            ON mail_jobs(status, next_attempt);
+    """),
+    (11, "Tag index and tag counts", """
+        CREATE TABLE IF NOT EXISTS material_tags(
+            material_id  INTEGER,
+            tag          TEXT,
+            PRIMARY KEY (material_id, tag)
+        );
+        CREATE INDEX IF NOT EXISTS material_tags_tag
+            ON material_tags(tag, material_id);
+        CREATE TABLE IF NOT EXISTS tag_counts(
+            tag          TEXT PRIMARY KEY,
+            count        INTEGER DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS tag_counts_count ON tag_counts(count);
+        CREATE TRIGGER IF NOT EXISTS tag_counts_insert
+        AFTER INSERT ON material_tags BEGIN
+            INSERT OR IGNORE INTO tag_counts(tag) VALUES(new.tag);
+            UPDATE tag_counts SET count=count+1 WHERE tag=new.tag;
+        END;
+        CREATE TRIGGER IF NOT EXISTS tag_counts_delete
+        AFTER DELETE ON material_tags BEGIN
+            UPDATE tag_counts SET count=count-1 WHERE tag=old.tag;
+            DELETE FROM tag_counts WHERE tag=old.tag AND count <= 0;
+        END;
+    """),
+    (12, "Backfill the tag index", copy_tags_to_material_tags),
+    (13, "Material counts of courses", """
+        ALTER TABLE courses ADD COLUMN material_count INTEGER DEFAULT 0;
+        UPDATE courses SET material_count=(SELECT count(*) FROM materials
+            WHERE materials.course_id=courses.id);
+        CREATE INDEX IF NOT EXISTS courses_material_count
+            ON courses(material_count);
+        CREATE TRIGGER IF NOT EXISTS courses_material_count_insert
+        AFTER INSERT ON materials BEGIN
+            UPDATE courses SET material_count=material_count+1
+            WHERE id=new.course_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS courses_material_count_update
+        AFTER UPDATE OF course_id ON materials BEGIN
+            UPDATE courses SET material_count=material_count-1
+            WHERE id=old.course_id;
+            UPDATE courses SET material_count=material_count+1
+            WHERE id=new.course_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS courses_material_count_delete
+        AFTER DELETE ON materials BEGIN
+            UPDATE courses SET material_count=material_count-1
+            WHERE id=old.course_id;
+        END;
+    """),
+    (14, "HOT scores of materials", """
+        ALTER TABLE materials ADD COLUMN hot REAL DEFAULT %r;
+        UPDATE materials SET hot=hot_score(points, comments, date_added);
+        CREATE INDEX IF NOT EXISTS materials_hot ON materials(hot);
+        CREATE TRIGGER IF NOT EXISTS materials_hot_insert
+        AFTER INSERT ON materials BEGIN
+            UPDATE materials SET hot=hot_score(new.points, new.comments,
+                new.date_added) WHERE id=new.id;
+        END;
+    """ % hot_score(0, 0, None)),
+    (15, "Generation counters shared by worker processes", """
+        CREATE TABLE IF NOT EXISTS generations(
+            name         TEXT PRIMARY KEY,
+            value        INTEGER NOT NULL DEFAULT 0
+        );
+    """),
+]
+
+
+def schema_version(conn):
+    """Returns the version of the latest migration applied to a database."""
+    conn.execute("""CREATE TABLE IF NOT EXISTS schema_version(
+        version      INTEGER PRIMARY KEY,
+        description  TEXT,
+        date_applied TEXT DEFAULT CURRENT_TIMESTAMP)""")
+    return conn.execute("SELECT max(version) FROM schema_version"
+        ).fetchone()[0] or 0
+
+
+def split_statements(script):
+    """Splits an SQL script into statements, keeping trigger bodies whole.
+
+    >>> split_statements("CREATE TABLE a(id); CREATE TRIGGER t AFTER INSERT "
+    ...     "ON a BEGIN DELETE FROM a; END; ")
+    ['CREATE TABLE a(id);', 'CREATE TRIGGER t AFTER INSERT ON a BEGIN DELETE FROM a; END;']
+    """
+    statements = []
+    statement = ""
+    for part in script.split(";")[:-1]:
+        statement += part + ";"
+        if sqlite3.complete_statement(statement):
+            statements.append(statement.strip())
+            statement = ""
+    return statements
+
+
+def migrate(conn, migrations=MIGRATIONS):
+    """Applies pending migrations, each in its own transaction. The write lock
+    is taken before the version is checked again, so processes starting at
+    the same time apply each step once. The connection must be in autocommit
+    mode (isolation_level None). Returns the resulting schema version.
+
+    >>> conn = sqlite3.connect(":memory:"); conn.isolation_level = None
+    >>> steps = [(1, "a", "CREATE TABLE a(id INTEGER);"),
+    ...          (2, "b", lambda c: c.execute("INSERT INTO a VALUES(1)"))]
+    >>> migrate(conn, steps), migrate(conn, steps)
+    (2, 2)
+    >>> conn.execute("SELECT count(*) FROM a").fetchone()[0]
+    1
+    >>> migrate(conn, steps + [(3, "c", "INSERT INTO a VALUES(2); nonsense;")])
+    Traceback (most recent call last):
+    OperationalError: near "nonsense": syntax error
+    >>> schema_version(conn), conn.execute("SELECT count(*) FROM a").fetchone()[0]
+    (2, 1)
+    """
+    version = schema_version(conn)
+    for number, description, step in migrations:
+        if number <= version:
+            continue
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            version = schema_version(conn)
+            if number > version:
+                if callable(step):
+                    step(conn)
+                else:
+                    for statement in split_statements(step):
+                        conn.execute(statement)
+                conn.execute("""INSERT INTO schema_version(version,
+                    description) VALUES(?, ?)""", (number, description))
+            conn.execute("COMMIT")
+        except Exception:
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.OperationalError:
+                pass  # The transaction was never started.
+            raise
+        version = max(version, number)
+    return version
+
+
+def fts_query(search):
+    """Turns a free-text search into an FTS5 query where every word is
+    matched as a prefix.
+
+    >>> fts_query(u'tiea2 "ohjelmointi') == u'"tiea2"* "ohjelmointi"*'
+    True
+    >>> fts_query(u'"')
+    u'""'
+    """
+    terms = [term.replace('"', "") for term in search.split()]
+    return u" ".join([u'"%s"*' % term for term in terms if term]) or u'""'
+
+
+def normalize_key(text):
+    """Case folds a string and collapses its whitespace for prefix lookups.
+
+    >>> normalize_key(u"  \\xc4idinkieli  JA kirjallisuus ") == u"\\xe4idinkieli ja kirjallisuus"
+    True
+    """
+    if isinstance(text, str):
+        text = text.decode("utf-8")
+    return u" ".join((text or u"").lower().split())
+
+
+class CourseIndex:
+    """An in-memory prefix index over course codes and titles, used for
+    autocompletion without querying the database. Titles can be matched from
+    the start of any word.
+
+    >>> index = CourseIndex([web.Storage(id=1, code=u"TIEA2011", title=u"Ohjelmointi 1")])
+    >>> index.add(web.Storage(id=2, code=u"TIES4500", title=u"Tietokannat ja ohjelmointi"))
+    >>> [c.id for c in index.search(u"ohjelm")]
+    [2, 1]
+    >>> [c.id for c in index.search(u"tie", code_only=True)]
+    [1, 2]
+    >>> [c.id for c in index.search(u"tietokannat j")]
+    [2]
+    >>> index.search(u"ties", limit=1)[0].code
+    u'TIES4500'
+    """
+
+    def __init__(self, courses=()):
+        self.lock = threading.Lock()
+        self.courses = {}
+        self.codes = []   # Sorted (normalized code, id) pairs.
+        self.titles = []  # Sorted (normalized title suffix, id) pairs.
+        for course in courses:
+            self._index(course)
+        self.codes.sort()
+        self.titles.sort()
+
+    def _keys(self, course):
+        """Returns the code and title keys of a course. Every word of the
+        title starts a key of its own."""
+        words = normalize_key(course.title).split()
+        titles = [u" ".join(words[i:]) for i in range(len(words))]
+        return [(normalize_key(course.code), course.id)], \
+            [(title, course.id) for title in titles]
+
+    def _index(self, course):
+        self.courses[course.id] = course
+        codes, titles = self._keys(course)
+        self.codes.extend(codes)
+        self.titles.extend(titles)
+
+    def add(self, course):
+        """Adds a new course to the index."""
+        codes, titles = self._keys(course)
+        with self.lock:
+            self.courses[course.id] = course
+            for key in codes:
+                bisect.insort(self.codes, key)
+            for key in titles:
+                bisect.insort(self.titles, key)
+
+    def search(self, prefix, limit=None, code_only=False):
+        """Returns courses whose code or a title word starts with the given
+        prefix, code matches first."""
+        prefix = normalize_key(prefix)
+        if not prefix:
+            return []
+        keys = [self.codes] if code_only else [self.codes, self.titles]
+        ids = []
+        seen = set()
+        with self.lock:
+            for sorted_keys in keys:
+                i = bisect.bisect_left(sorted_keys, (prefix,))
+                while i < len(sorted_keys) and (limit is None or len(ids) < limit):
+                    key, id = sorted_keys[i]
+                    if not key.startswith(prefix):
+                        break
+                    if not id in seen:
+                        seen.add(id)
+                        ids.append(id)
+                    i += 1
+            return [self.courses[id] for id in ids]
+
+
+def connect(path, busy_timeout=BUSY_TIMEOUT, **kws):
+    """Opens an sqlite3 connection with the tuned pragmas."""
+    conn = sqlite3.connect(path, **kws)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    conn.create_function("hot_score", 3, hot_score)
+    conn.execute("PRAGMA busy_timeout=%d" % (busy_timeout * 1000))
+    return conn
+
+
+class BusyRetryCursor:
+    """Wraps a cursor, retrying statements with backoff while the database is
+    locked by another writer and recording how long was waited."""
+
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+
+    def execute(self, query, params=()):
+        waited, delay = 0.0, 0.01
+        while True:
+            try:
+                return self.cursor.execute(query, params)
+            except sqlite3.OperationalError, e:
+                if not "locked" in str(e) or waited >= BUSY_TIMEOUT:
+                    raise
+                self.stats.busy(delay)
+                time.sleep(delay)
+                waited += delay
+                delay = min(delay * 2, 0.5)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class ConnectionStats:
+    """Counters describing the connection layer."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.threads = set()
+        self.busy_waits = 0
+        self.busy_seconds = 0.0
+        self.statement_hits = 0
+        self.statement_misses = 0
+
+    def connected(self):
+        with self.lock:
+            self.connections += 1
+            self.threads.add(threading.current_thread().ident)
+
+    def busy(self, seconds):
+        with self.lock:
+            self.busy_waits += 1
+            self.busy_seconds += seconds
+
+    def as_dict(self):
+        alive = set([t.ident for t in threading.enumerate()])
+        return {"connections_opened": self.connections,
+                "connections_open": len(self.threads & alive),
+                "busy_waits": self.busy_waits,
+                "busy_seconds": round(self.busy_seconds, 3),
+                "statement_cache_hits": self.statement_hits,
+                "statement_cache_misses": self.statement_misses}
+
+
+class Timings:
+    """Counts, total time and a latency histogram of each series of timed
+    operations, e.g. each distinct query. Series are identified by tuples of
+    label values.
+
+    >>> timings = Timings([0.01, 0.1])
+    >>> timings.observe(("a",), 0.005); timings.observe(("a",), 0.5)
+    >>> print timings.prometheus("t_seconds", ["name"], "Test timings.")
+    # HELP t_seconds Test timings.
+    # TYPE t_seconds histogram
+    t_seconds_bucket{name="a",le="0.01"} 1
+    t_seconds_bucket{name="a",le="0.1"} 1
+    t_seconds_bucket{name="a",le="+Inf"} 2
+    t_seconds_sum{name="a"} 0.505000
+    t_seconds_count{name="a"} 2
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # Labels -> [count, total seconds, count of each bucket]:
+        self.series = {}
+
+    def observe(self, labels, seconds):
+        bucket = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0, 0.0] + [0] * len(self.buckets)
+            series[0] += 1
+            series[1] += seconds
+            if bucket < len(self.buckets):
+                series[2 + bucket] += 1
+
+    def prometheus(self, name, label_names, help):
+        """Returns the histograms in the Prometheus text format."""
+        with self.lock:
+            series = sorted((labels, list(s)) for labels, s in self.series.items())
+        lines = ["# HELP %s %s" % (name, help), "# TYPE %s histogram" % name]
+        for labels, s in series:
+            labels = ",".join('%s="%s"' % (n, prometheus_escape(v))
+                              for n, v in zip(label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets, s[2:]):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%s"} %d'
+                             % (name, labels, bound, cumulative))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, s[0]))
+            lines.append("%s_sum{%s} %.6f" % (name, labels, s[1]))
+            lines.append("%s_count{%s} %d" % (name, labels, s[0]))
+        return "\n".join(lines)
+
+
+def prometheus_escape(value):
+    """Escapes a label value for the Prometheus text format."""
+    value = web.safestr(value)
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class SqliteDB(web.db.SqliteDB):
+    """web.py's SQLite database with one tuned connection per thread, retries
+    on a locked database, and a cache of parsed statements. Queries are only
+    parsed once per distinct query string, and as the resulting SQL is the same
+    each time, sqlite3 reuses its prepared statement too. The time each
+    statement takes to execute (not to read all of its rows) is recorded in
+    timings by its SQL, and slow statements are printed.
+
+    >>> db = SqliteDB(":memory:")
+    >>> _ = db.query("CREATE TABLE t(id INTEGER PRIMARY KEY, name TEXT)")
+    >>> _ = db.query("INSERT INTO t(name) VALUES($name)", {"name": u"a"})
+    >>> [db.query("SELECT name FROM t WHERE id=$id", {"id": 1})[0].name for i in range(2)]
+    [u'a', u'a']
+    >>> db.stats.statement_hits, db.stats.statement_misses
+    (1, 3)
+    >>> db.timings.series[("SELECT name FROM t WHERE id=%s",)][0]
+    2
+    """
+    STATEMENT_CACHE_SIZE = 500
+    variable = re.compile(r"\$([A-Za-z_]\w*)")
+
+    def __init__(self, path, **keywords):
+        keywords.setdefault("cached_statements", self.STATEMENT_CACHE_SIZE)
+        self.stats = ConnectionStats()
+        self.statements = {}  # Query string -> list of chunks and var names.
+        self.timings = Timings()
+        self.query_names = {}  # SQL with its whitespace collapsed.
+        web.db.SqliteDB.__init__(self, db=path, **keywords)
+
+    def _connect(self, keywords):
+        conn = web.db.SqliteDB._connect(self, keywords)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        conn.create_function("hot_score", 3, hot_score)
+        # Keep SQLite's own wait short; BusyRetryCursor retries and measures:
+        conn.execute("PRAGMA busy_timeout=100")
+        self.stats.connected()
+        return conn
+
+    def _db_cursor(self):
+        return BusyRetryCursor(self.ctx.db.cursor(), self.stats)
+
+    def _db_execute(self, cur, sql_query):
+        start = time.time()
+        try:
+            return web.db.SqliteDB._db_execute(self, cur, sql_query)
+        finally:
+            seconds = time.time() - start
+            query = sql_query.query()
+            name = self.query_names.get(query)
+            if name is None:
+                name = " ".join(query.split())
+                if len(self.query_names) < self.STATEMENT_CACHE_SIZE:
+                    self.query_names[query] = name
+            self.timings.observe((name,), seconds)
+            if seconds > SLOW_QUERY:
+                print "Slow query (%.3f s): %s %r" % (seconds, name,
+                    sql_query.values())
+
+    def _parse(self, query):
+        """Splits a query into SQL chunks and (None, variable name) pairs."""
+        parts = []
+        for i, part in enumerate(self.variable.split(query)):
+            parts.append((None, part) if i % 2 else part)
+        return parts
+
+    def query(self, sql_query, vars=None, processed=False, _test=False):
+        if processed or not isinstance(sql_query, basestring):
+            return web.db.SqliteDB.query(self, sql_query, vars, processed, _test)
+        parts = self.statements.get(sql_query)
+        if parts is None:
+            self.stats.statement_misses += 1
+            parts = self._parse(sql_query)
+            if len(self.statements) < self.STATEMENT_CACHE_SIZE:
+                self.statements[sql_query] = parts
+        else:
+            self.stats.statement_hits += 1
+        vars = vars or {}
+        items = [web.db.sqlparam(vars[part[1]]) if isinstance(part, tuple)
+                 else part for part in parts]
+        return web.db.SqliteDB.query(self, web.db.SQLQuery(items),
+            _test=_test)
+
+
+class CounterBuffer:
+    """Collects increments to counter columns (e.g. materials.points) in
+    memory and writes them to the database in batches, either every
+    `interval` seconds or once `max_pending` counters have changed. Buffered
+    values are merged into reads, so counts stay correct between flushes.
+    `derived` maps tables to statements that recompute columns derived from
+    the counters, run with the id of each updated row. `flushed` is called
+    with the (table, id) pairs of the rows each flush wrote.
+
+    >>> conn = sqlite3.connect(":memory:", check_same_thread=False)
+    >>> _ = conn.execute("CREATE TABLE t(id INTEGER PRIMARY KEY, n INTEGER)")
+    >>> _ = conn.execute("INSERT INTO t VALUES(1, 0)")
+    >>> counters = CounterBuffer(conn, max_pending=2)
+    >>> counters.add("t", "n", 1), counters.add("t", "n", 1, 2)
+    (1, 3)
+    >>> conn.execute("SELECT n FROM t").fetchone()[0], counters.pending("t", "n", 1)
+    (0, 3)
+    >>> _ = counters.add("t", "n", 2); conn.execute("SELECT n FROM t").fetchone()[0]
+    3
+    >>> counters.stop()
+    """
+
+    def __init__(self, conn, interval=1.0, max_pending=100, derived=None,
+                 flushed=None):
+        self.conn = conn
+        self.interval = interval
+        self.max_pending = max_pending
+        self.derived = derived or {}
+        self.flushed = flushed
+        self.lock = threading.RLock()
+        self.deltas = {}  # (table, column, id) -> buffered increment
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add(self, table, column, id, delta=1):
+        """Buffers an increment, returns the counter's total buffered
+        increment."""
+        with self.lock:
+            key = (table, column, id)
+            self.deltas[key] = self.deltas.get(key, 0) + delta
+            pending = self.deltas[key]
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+                atexit.register(self.stop)
+            if len(self.deltas) >= self.max_pending:
+                self.flush()
+        return pending
+
+    def pending(self, table, column, id):
+        """Returns the buffered increment of a counter."""
+        return self.deltas.get((table, column, id), 0)
+
+    def discard(self, table, id):
+        """Drops the buffered increments of a deleted row."""
+        with self.lock:
+            for key in self.deltas.keys():
+                if key[0] == table and key[2] == id:
+                    del self.deltas[key]
+
+    def flush(self):
+        """Writes all buffered increments in a single transaction."""
+        with self.lock:
+            if not self.deltas:
+                return
+            updates = {}
+            for (table, column, id), delta in self.deltas.items():
+                updates.setdefault((table, column), []).append((delta, id))
+            try:
+                for (table, column), rows in updates.items():
+                    self.conn.executemany("UPDATE %s SET %s=%s+? WHERE id=?" %
+                        (table, column, column), rows)
+                for table, statement in self.derived.items():
+                    ids = set((id,) for (t, _, id) in self.deltas if t == table)
+                    self.conn.executemany(statement, ids)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            rows = set((table, id) for (table, _, id) in self.deltas)
+            self.deltas = {}
+            if self.flushed:
+                self.flushed(rows)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except sqlite3.Error, e:
+                print "Flushing counters failed:", e
+
+    def stop(self):
+        """Stops the flushing thread and writes what is left."""
+        self.stopped.set()
+        self.flush()
+
+
+class RowCache:
+    """A read-through LRU cache of rows looked up by a key column, e.g.
+    users by name. Entries expire after `ttl` seconds. Writers invalidate the
+    rows they change, which evicts every lookup that returned those rows.
+    A lookup that raced with an invalidation is not cached.
+
+    >>> cache = RowCache(max_size=2)
+    >>> cache.get("users", "name", u"a")
+    >>> cache.put("users", "name", u"a", [web.Storage(id=1, name=u"a")])
+    >>> cache.get("users", "name", u"a")[0].id
+    1
+    >>> cache.invalidate_row("users", 1); cache.get("users", "name", u"a")
+    >>> stats = cache.stats(); stats["hits"], stats["misses"], stats["hit_rate"]
+    (1, 2, 0.333)
+    """
+
+    def __init__(self, max_size=ROW_CACHE_SIZE, ttl=ROW_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (table, column, value) -> (expiry time, rows), least recent first:
+        self.entries = collections.OrderedDict()
+        self.keys = {}  # (table, id) -> keys of the entries holding the row
+        self.generation = 0  # Incremented by every invalidation.
+        self.hits = self.misses = 0
+        self.evictions = self.expirations = self.invalidations = 0
+
+    def get(self, table, column, value):
+        """Returns copies of the cached rows, or None."""
+        key = (table, column, value)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.time():
+                self._forget(key, entry[1])
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+        return [web.Storage(row) for row in entry[1]]
+
+    def put(self, table, column, value, rows, generation=None):
+        """Caches the rows of a lookup, unless it returned nothing or rows
+        were invalidated since `generation` was read."""
+        key = (table, column, value)
+        with self.lock:
+            if not rows or generation not in (None, self.generation):
+                return
+            if key in self.entries:
+                self._forget(key, self.entries.pop(key)[1])
+            self.entries[key] = (time.time() + self.ttl,
+                                 [web.Storage(row) for row in rows])
+            for row in rows:
+                self.keys.setdefault((table, row.id), set()).add(key)
+            while len(self.entries) > self.max_size:
+                oldest, (_, old_rows) = self.entries.popitem(last=False)
+                self._forget(oldest, old_rows)
+                self.evictions += 1
+
+    def _forget(self, key, rows):
+        self.entries.pop(key, None)
+        for row in rows:
+            keys = self.keys.get((key[0], row.id))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys[(key[0], row.id)]
+
+    def invalidate_row(self, table, id):
+        """Evicts every lookup that returned the row."""
+        with self.lock:
+            self.generation += 1
+            for key in list(self.keys.get((table, id), ())):
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self._forget(key, entry[1])
+                    self.invalidations += 1
+            self.keys.pop((table, id), None)
+
+    def invalidate_key(self, table, column, value):
+        """Evicts a lookup, e.g. one that a new row now also matches."""
+        with self.lock:
+            self.generation += 1
+            entry = self.entries.get((table, column, value))
+            if entry is not None:
+                self._forget((table, column, value), entry[1])
+                self.invalidations += 1
+
+    def invalidate_table(self, table):
+        """Evicts every lookup of a table."""
+        with self.lock:
+            self.generation += 1
+            for key, entry in self.entries.items():
+                if key[0] == table:
+                    self._forget(key, entry[1])
+                    self.invalidations += 1
+
+    def stats(self):
+        """Returns hit and eviction counts, to help tune the cache's size."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self.entries), "max_size": self.max_size,
+                    "hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(float(self.hits) / lookups, 3)
+                                if lookups else 0.0,
+                    "evictions": self.evictions,
+                    "expirations": self.expirations,
+                    "invalidations": self.invalidations}
+
+
+class SessionStore(web.session.Store):
+    """A web.py session store in the sessions table, safe to share between
+    worker processes. Sessions read or written in the last `cache_ttl`
+    seconds are served from memory, unchanged sessions are only written again
+    to refresh their access time, and expired sessions are purged in batches
+    by a background thread.
+
+    >>> store = SessionStore(DatabaseHandler().db)
+    >>> store["abc"] = {"login": 1}; store["abc"]
+    {'login': 1}
+    >>> store.cache.clear(); "abc" in store, store["abc"]
+    (True, {'login': 1})
+    >>> store.db.query("UPDATE sessions SET atime=0 WHERE session_id='abc'")
+    1
+    >>> store.sweep(); store.cache.clear(); "abc" in store
+    False
+    """
+    SWEEP_INTERVAL = 60
+    SWEEP_BATCH = 500
+    MAX_CACHED = 10000
+
+    def __init__(self, db, cache_ttl=1.0, timeout=None):
+        self.db = db
+        self.cache_ttl = cache_ttl
+        self.timeout = timeout or web.config.session_parameters.timeout
+        self.touch_interval = min(self.timeout / 10.0, 60)
+        self.lock = threading.Lock()
+        # Session id -> (encoded data, time read, time written):
+        self.cache = collections.OrderedDict()
+        sweeper = threading.Thread(target=self._sweep_periodically)
+        sweeper.daemon = True
+        sweeper.start()
+
+    def _cached(self, key):
+        entry = self.cache.get(key)
+        if entry and time.time() - entry[1] < self.cache_ttl:
+            return entry
+        return None
+
+    def _remember(self, key, data, written):
+        with self.lock:
+            self.cache.pop(key, None)
+            self.cache[key] = (data, time.time(), written)
+            if len(self.cache) > self.MAX_CACHED:
+                self.cache.popitem(last=False)
+
+    def _load(self, key):
+        rows = self.db.query("""SELECT data, atime FROM sessions
+            WHERE session_id=$key""", {"key": key}).list()
+        if not rows:
+            return None
+        self._remember(key, rows[0].data, rows[0].atime)
+        return rows[0].data
+
+    def __contains__(self, key):
+        return bool(self._cached(key) or self._load(key))
+
+    def __getitem__(self, key):
+        entry = self._cached(key)
+        data = entry[0] if entry else self._load(key)
+        if data is None:
+            raise KeyError(key)
+        return self.decode(data)
+
+    def __setitem__(self, key, value):
+        data = self.encode(value)
+        entry = self.cache.get(key)
+        now = time.time()
+        # Skip the write if nothing changed and the access time is fresh:
+        if entry and entry[0] == data and now - entry[2] < self.touch_interval:
+            return
+        self.db.query("""INSERT OR REPLACE INTO sessions(session_id, data,
+            atime) VALUES($key, $data, $now)""", locals())
+        self._remember(key, data, now)
+
+    def __delitem__(self, key):
+        self.db.query("DELETE FROM sessions WHERE session_id=$key",
+            {"key": key})
+        with self.lock:
+            self.cache.pop(key, None)
+
+    def cleanup(self, timeout):
+        """Called by web.py during requests; the actual purging is left to
+        the background sweep."""
+        self.timeout = timeout
+
+    def sweep(self):
+        """Deletes expired sessions in batches, so that the write lock is
+        never held for long."""
+        cutoff = time.time() - self.timeout
+        while True:
+            deleted = self.db.query("""DELETE FROM sessions WHERE session_id
+                IN (SELECT session_id FROM sessions WHERE atime < $cutoff
+                LIMIT $batch)""", {"cutoff": cutoff, "batch": self.SWEEP_BATCH})
+            if deleted < self.SWEEP_BATCH:
+                break
+            time.sleep(0.01)
+
+    def _sweep_periodically(self):
+        while True:
+            time.sleep(self.SWEEP_INTERVAL)
+            try:
+                self.sweep()
+            except sqlite3.Error, e:
+                print "Sweeping sessions failed:", e
 
 
 class DatabaseHandler:
@@ -11,17 +988,109 @@ class DatabaseHandler:
 
     ### GENERAL ###
 
+    def query(self, query, vars=None):
+        """Runs a query. While explaining, only records the query's plan.
+
+        >>> db = DatabaseHandler(); _ = db.query("SELECT 1")
+        >>> db.query_timings.series[("SELECT 1",)][0] > 0
+        True
+        """
+        plans = getattr(self.local, "plans", None)
+        if plans is not None:
+            rows = self.db.query("EXPLAIN QUERY PLAN " + query, vars)
+            plans.append((query, [row.detail for row in rows]))
+            return iter([])
+        return self.db.query(query, vars)
+
+    def connection_stats(self):
+        """Returns statistics of the connection layer: connections opened and
+        still open (one per worker thread), how often and how long queries
+        waited for a locked database, and statement cache hits."""
+        return self.db.stats.as_dict()
+
+    def explain(self, method, *args, **kws):
+        """Calls a read method without running its queries, returns a list of
+        (query, plan) pairs of the queries it would run.
+
+        >>> db = DatabaseHandler()
+        >>> query, plan = db.explain(db.select, "users", name="u1")[0]
+        >>> "USING INDEX users_name" in plan[0]
+        True
+        """
+        self.local.plans = []
+        try:
+            method(*args, **kws)
+            return self.local.plans
+        finally:
+            self.local.plans = None
+
+    def print_query_plans(self):
+        """Prints query plans of the hot queries, so that it's easy to check
+        that each one uses an index. Full table scans are marked with '!'."""
+        hot_queries = [
+            (self.get_materials, {"order_by": "materials.date_added desc",
+                                  "limit": 30}),
+            (self.get_materials, {"order_by": "materials.hot desc",
+                                  "limit": 30}),
+            (self.get_materials, {"order_by": "materials.points desc",
+                                  "limit": 30}),
+            (self.get_materials, {"faculty": "IT", "limit": 30}),
+            (self.get_materials, {"course_id": 1, "limit": 30}),
+            (self.get_materials, {"user_id": 1, "limit": 30}),
+            (self.get_materials, {"id": 1}),
+            (self.get_materials, {"search": u"tentti", "limit": 30}),
+            (self.get_materials, {"tag": u"tentti", "limit": 30,
+                                  "order_by": "materials.id desc"}),
+            (self.get_tags, {"limit": 50}),
+            (self.get_courses, {"order_by": "material_count desc",
+                                "limit": 10}),
+            (self.get_comments, {"material_id": 1}),
+            (self.get_comments, {"material_id": 1, "since": 1}),
+            (self.select, {"tables": "users", "name": u"user"}),
+            (self.select, {"tables": "users", "conf_code": u"code"}),
+            (self.select, {"tables": "courses", "code": u"TIEA2011"}),
+        ]
+        for method, kws in hot_queries:
+            args = ", ".join(["%s=%r" % item for item in sorted(kws.items())])
+            print "%s(%s)" % (method.__name__, args)
+            for query, plan in self.explain(method, **kws):
+                for detail in plan:
+                    scan = detail.startswith("SCAN") and not "INDEX" in detail
+                    print "  %s %s" % ("!" if scan else " ", detail)
+
     def select(self, tables, values="*", order_by=None, limit=None, **kws):
         """Selects rows from given table, kws determines WHERE-clauses.
+        Whole rows looked up by a single key in CACHED_KEYS are read through
+        the row cache.
 
         >>> db=DatabaseHandler();id1=db.insert("users",name="u1",points=1)
         >>> id2 = db.insert("users", name="u1", points=2)
         >>> db.select("users", name="u1", points=1)[0].id == id1
         True
-        >>> db.delete("users", id=id1); db.delete("users", id=id2)
+        >>> len(db.select("users", name="u1").list()), db.select("users", id=id1)[0].points
+        (2, 1)
+        >>> db.update("users", id1, points=5); db.select("users", id=id1)[0].points
+        5
+        >>> db.delete("users", id=id2); len(db.select("users", name="u1").list())
+        1
+        >>> db.delete("users", id=id1)
         """
         if type(tables) == list:
             tables = ",".join(tables)
+        if (values == "*" and not order_by and not limit and len(kws) == 1
+                and kws.keys()[0] in CACHED_KEYS.get(tables, ())
+                and getattr(self.local, "plans", None) is None
+                and not self.db.ctx.transactions):
+            (column, value), = kws.items()
+            rows = self.row_cache.get(tables, column, value)
+            if rows is None:
+                generation = self.row_cache.generation
+                rows = self.query("SELECT * FROM %s WHERE %s=$value"
+                                  % (tables, column), locals()).list()
+                self.row_cache.put(tables, column, value, rows, generation)
+            result = web.iterbetter(iter(rows))
+            result.list = lambda: rows
+            return result
 
         clauses = " AND ".join(["%s=$%s" % (key, key) for key in kws])
         clauses = " WHERE " + clauses if clauses else ""
@@ -31,7 +1100,13 @@ class DatabaseHandler:
             clauses += " LIMIT $limit"
         query = "SELECT " + values + " FROM " + tables + clauses
         kws["limit"] = limit
-        return self.db.query(query, kws)
+        return self.query(query, kws)
+
+    def insert(self, table, **values):
+        """Inserts a row, returns its id."""
+        id = self.db.insert(table, **values)
+        self._written(table, [], values)
+        return id
 
     def delete(self, table, **kws):
         """Deletes all rows or a given row from a table."""
@@ -39,7 +1114,17 @@ class DatabaseHandler:
         clauses = " AND ".join(["%s=$%s" % (key, key) for key in kws])
         if clauses:
             query = query + " WHERE " + clauses
-        self.db.query(query, kws)
+        if not kws:
+            for other in [table] + [t for t, _ in CACHE_DEPENDENTS.get(table, [])]:
+                self._invalidate(self.row_cache.invalidate_table, other)
+            rows = []
+        elif table in CACHED_KEYS or table in CACHE_DEPENDENTS:
+            columns = ["id"] + [c for _, c in CACHE_DEPENDENTS.get(table, [])]
+            rows = list(self.select(table, ", ".join(columns), **kws))
+        else:
+            rows = []
+        self.query(query, kws)
+        self._written(table, rows, {})
 
     def update(self, table, id, **kws):
         """Updates a row from selected table, kws determines which values are
@@ -56,23 +1141,112 @@ class DatabaseHandler:
         for key in kws:
             values.append("%s=$%s" % (key, key))
         query = "UPDATE %s SET %s WHERE id=$id" % (table, ",".join(values))
+        # Triggers also update the rows that the old values referred to:
+        columns = [c for _, c in CACHE_DEPENDENTS.get(table, []) if c in kws]
+        rows = [web.Storage(id=id)]
+        if columns:
+            rows = list(self.select(table, ", ".join(["id"] + columns), id=id))
         kws["id"] = id
-        self.db.query(query, kws)
+        self.query(query, kws)
+        del kws["id"]
+        self._written(table, rows, kws)
+
+    def transaction(self):
+        """Starts a web.py transaction. Rows written in it are evicted from
+        the row cache again once the outermost transaction has ended, since
+        other threads may cache the old rows until it commits."""
+        return self._transaction(not self.db.ctx.transactions)
+
+    @contextlib.contextmanager
+    def _transaction(self, outermost):
+        try:
+            with self.db.transaction():
+                yield
+        finally:
+            if outermost:
+                deferred, self.local.deferred = self._deferred(), []
+                for method, args in deferred:
+                    method(*args)
+
+    def _deferred(self):
+        if getattr(self.local, "deferred", None) is None:
+            self.local.deferred = []
+        return self.local.deferred
+
+    def _invalidate(self, method, *args):
+        """Calls a row cache invalidation method now and, inside a
+        transaction, again once it ends."""
+        method(*args)
+        if self.db.ctx.transactions:
+            self._deferred().append((method, args))
+
+    def _written(self, table, rows, values):
+        """Evicts what a write made stale from the row cache: the written
+        rows, lookups by the written key values, and rows that triggers
+        update through the written rows' references."""
+        dependents = CACHE_DEPENDENTS.get(table, [])
+        for row in rows:
+            self._invalidate(self.row_cache.invalidate_row, table, row.id)
+            for other, column in dependents:
+                if row.get(column) is not None:
+                    self._invalidate(self.row_cache.invalidate_row, other,
+                                     row[column])
+        for column, value in values.items():
+            if column in CACHED_KEYS.get(table, ()):
+                self._invalidate(self.row_cache.invalidate_key, table, column,
+                                 value)
+            for other, dependent_column in dependents:
+                if column == dependent_column and value is not None:
+                    self._invalidate(self.row_cache.invalidate_row, other,
+                                     value)
+
+    def _counters_flushed(self, rows):
+        for table, id in rows:
+            self.row_cache.invalidate_row(table, id)
+
+    def row_cache_stats(self):
+        """Returns the row cache's size, hit rate and eviction counts."""
+        return self.row_cache.stats()
+
+    def get_generation(self, name):
+        """Returns a generation counter, which every worker process sees.
+
+        >>> db = DatabaseHandler(); before = db.get_generation("test")
+        >>> db.bump_generation("test") == db.get_generation("test") == before + 1
+        True
+        """
+        rows = self.query("SELECT value FROM generations WHERE name=$name",
+            locals()).list()
+        return rows[0].value if rows else 0
+
+    def bump_generation(self, name):
+        """Increments a generation counter, returns its new value."""
+        self.query("""INSERT INTO generations(name, value) VALUES($name, 1)
+            ON CONFLICT(name) DO UPDATE SET value=value+1""", locals())
+        return self.get_generation(name)
 
     ### USERS ###
 
     def user_increase_points(self, id):
         """Increases user's points by one."""
-        pts = self.select("users", id)[0].points + 1
-        self.db.update("users", id, points=pts)
+        self.counters.add("users", "points", id)
 
     ### COURSES ###
 
     def get_courses(self, id=None, order_by=None, limit=None):
-        """Selects courses and the number of materials they have."""
-        query = """SELECT id, code, title, faculty,
-                (SELECT count(*) FROM materials
-                WHERE materials.course_id=courses.id)
+        """Selects courses and the number of materials they have. The counts
+        are kept in courses.material_count by triggers on materials, so the
+        most popular courses are read from its index.
+
+        >>> db = DatabaseHandler(); cid = db.insert("courses")
+        >>> mid = db.insert("materials", course_id=cid)
+        >>> db.get_courses(id=cid)[0].materials
+        1
+        >>> db.delete_material(mid), db.get_courses(id=cid)[0].materials
+        (1, 0)
+        >>> db.delete("courses", id=cid)
+        """
+        query = """SELECT id, code, title, faculty, material_count
                 AS materials FROM courses"""
         if id:
             query += " WHERE id=$id"
@@ -81,22 +1255,110 @@ class DatabaseHandler:
         if limit:
             query += " LIMIT $limit"
 
-        return self.db.query(query, locals())
+        return self.query(query, locals())
+
+    def search_courses(self, search, code_only=False, limit=None):
+        """Returns courses whose code or title starts with the given query.
+        Served from the in-memory course index, which is rebuilt when another
+        process has changed the catalog. That is checked at most once every
+        CATALOG_CHECK_INTERVAL seconds.
+
+        >>> db, other = DatabaseHandler(), DatabaseHandler()
+        >>> id = other.add_course(u"GENR01", u"Sukupolvet", u"IT")
+        >>> db.search_courses(u"GENR01")
+        []
+        >>> db.catalog_checked -= CATALOG_CHECK_INTERVAL  # Time passes.
+        >>> [c.id for c in db.search_courses(u"GENR01")] == [id]
+        True
+        >>> db.delete("courses", id=id)
+        """
+        now = time.time()
+        if now - self.catalog_checked > CATALOG_CHECK_INTERVAL:
+            self.catalog_checked = now
+            if self.get_generation("catalog") != self.catalog_generation:
+                self._load_course_index()
+        return self.course_index.search(search, limit, code_only)
+
+    def _load_course_index(self):
+        self.catalog_checked = time.time()
+        self.catalog_generation = self.get_generation("catalog")
+        self.course_index = CourseIndex(
+            self.select("courses", "id, code, title, faculty"))
+        self.row_cache.invalidate_table("courses")
+
+    def add_course(self, code, title, faculty):
+        """Inserts a new course and adds it to the course index, returns the
+        new course's id."""
+        id = self.insert("courses", code=code, title=title, faculty=faculty)
+        self.course_index.add(web.Storage(id=id, code=code, title=title,
+            faculty=faculty))
+        # Other processes rebuild their indexes; this one is up to date
+        # unless the catalog changed meanwhile:
+        generation = self.bump_generation("catalog")
+        if generation == self.catalog_generation + 1:
+            self.catalog_generation = generation
+        return id
 
-    def search_courses(self, search, code_only=False):
-        """Selects courses whose code or title match the given query."""
-        search = "%" + search + "%"
-        query = "SELECT * from courses WHERE code LIKE $search"
-        if not code_only:
-            query += " OR title LIKE $search"
-        return self.db.query(query, {"search": search})
+    def import_courses(self, courses, batch_size=1000):
+        """Inserts courses from an iterable of (code, title, faculty) tuples,
+        or updates the title and faculty of courses whose code already exists.
+        Courses are written with executemany in batches, one transaction per
+        batch, and unchanged ones are skipped. Bumps the catalog generation,
+        so that every process rebuilds its course index.
+        Returns the numbers of inserted and updated courses.
+
+        >>> db = DatabaseHandler()
+        >>> db.import_courses([(u"IMPRT01", u"A", u"IT"), (u"IMPRT02", u"B", u"IT"),
+        ...     (u"IMPRT01", u"C", u"HUM"), (u"IMPRT02", u"B", u"IT")], batch_size=2)
+        (2, 1)
+        >>> [(c.code, c.title) for c in db.search_courses(u"IMPRT")]
+        [(u'IMPRT01', u'C'), (u'IMPRT02', u'B')]
+        >>> db.query("DELETE FROM courses WHERE code LIKE 'IMPRT%'")
+        2
+        """
+        conn = connect(self.path)
+        try:
+            # Code -> (title, faculty) of every course:
+            existing = dict((code, (title, faculty)) for code, title, faculty
+                in conn.execute("SELECT code, title, faculty FROM courses"))
+            inserted = updated = 0
+            courses = iter(courses)
+            while True:
+                batch = collections.OrderedDict((code, (title, faculty))
+                    for code, title, faculty
+                    in itertools.islice(courses, batch_size))
+                if not batch:
+                    break
+                inserts = [(code, title, faculty) for code, (title, faculty)
+                           in batch.items() if code not in existing]
+                updates = [(title, faculty, code) for code, (title, faculty)
+                           in batch.items()
+                           if existing.get(code, (title, faculty)) != (title, faculty)]
+                with conn:
+                    conn.executemany("""INSERT INTO courses(code, title, faculty)
+                        VALUES(?, ?, ?)""", inserts)
+                    conn.executemany("""UPDATE courses SET title=?, faculty=?
+                        WHERE code=?""", updates)
+                existing.update(batch)
+                inserted += len(inserts)
+                updated += len(updates)
+        finally:
+            conn.close()
+            self.bump_generation("catalog")
+            self._load_course_index()
+        return inserted, updated
 
     ### MATERIALS ###
 
     def get_materials(self, id=None, course_id=None, user_id=None,
-        faculty=None, search=None, order_by=None, limit=None):
+        faculty=None, search=None, order_by=None, limit=None, after=None,
+        fields=None, tag=None):
         """Returns all materials that match the given criteria.
         Includes information about the course and the user who submitted the material.
+        When ordered by a single column, each row has a sort_key, and the next
+        page starts after the (sort_key, id) pair of the last row. Searches
+        are ordered by rank, so their results are paged the same way. If fields
+        is given, only those keys of MATERIAL_FIELDS and the id are selected.
 
         >>> db = DatabaseHandler();uid = db.insert("users");cid = db.insert("courses");
         >>> mid = db.insert("materials", course_id=cid, user_id=uid)
@@ -104,96 +1366,336 @@ class DatabaseHandler:
         True
         >>> db.get_materials(user_id=uid)[0].name == db.select("users",id=uid)[0].name
         True
+        >>> db.update("materials", mid, title=u"Tentti kysymykset")
+        >>> db.get_materials(search=u"kysym")[0].id == mid
+        True
         >>> db.delete("materials",id=mid); db.delete("courses",id=cid); db.delete("users",id=uid)
+        >>> list(db.get_materials(search=u"kysym"))
+        []
+        >>> uid, cid = db.insert("users"), db.insert("courses")
+        >>> ids = [db.insert("materials", course_id=cid, user_id=uid, points=p) for p in [5, 5, 3]]
+        >>> first = list(db.get_materials(course_id=cid, order_by="materials.points desc", limit=2))
+        >>> rest = list(db.get_materials(course_id=cid, order_by="materials.points desc", limit=2,
+        ...     after=(first[-1].sort_key, first[-1].id)))
+        >>> [m.id for m in first + rest] == [ids[1], ids[0], ids[2]]
+        True
+        >>> sorted(db.get_materials(id=ids[0], fields=["points", "code"])[0])
+        ['code', 'id', 'points']
+        >>> db.add_material_tags(ids[2], u"Kaavat")
+        >>> [m.id for m in db.get_materials(tag=u"kaavat")] == [ids[2]]
+        True
+        >>> ids += [db.insert("materials", course_id=cid, user_id=uid,
+        ...     title=u"Sivutettu haku") for i in range(3)]
+        >>> first = list(db.get_materials(search=u"sivutettu", limit=2))
+        >>> rest = list(db.get_materials(search=u"sivutettu", limit=2,
+        ...     after=(first[-1].sort_key, first[-1].id)))
+        >>> sorted(m.id for m in first + rest) == ids[3:]
+        True
+        >>> for id in ids: _ = db.delete_material(id)
+        >>> db.delete("courses", id=cid); db.delete("users", id=uid)
+        >>> db.get_materials(fields=["hash"])
+        Traceback (most recent call last):
+        ...
+        ValueError: Unknown field: hash
         """
         args = locals()
-        search = "%" + search + "%" if search else None
-        query = """SELECT materials.*, courses.code, courses.title
+        search = fts_query(search) if search else None
+        tag = tag.lower() if tag else None
+        if fields:
+            for field in fields:
+                if field not in MATERIAL_FIELDS:
+                    raise ValueError("Unknown field: %s" % field)
+            fields = ["id"] + [f for f in fields if f != "id"]
+            # Buffered likes are merged into user_points by user_id:
+            if "user_points" in fields and "user_id" not in fields:
+                fields.append("user_id")
+            columns = ", ".join("%s AS %s" % (MATERIAL_FIELDS[f], f)
+                for f in fields)
+        else:
+            columns = """materials.*, courses.code, courses.title
                 AS course_title, courses.faculty, users.name, users.points AS
-                user_points FROM materials JOIN courses ON course_id=courses.id
-                JOIN users ON user_id=users.id"""
+                user_points"""
+        query = """SELECT %s FROM materials JOIN courses ON course_id=courses.id
+                JOIN users ON user_id=users.id""" % columns
+        # Searches go through the full-text index instead of scanning:
+        if search:
+            query = query.replace("FROM materials", """FROM materials_fts
+                JOIN materials ON materials.id=materials_fts.rowid""", 1)
+            order_by = order_by or "materials_fts.rank"
 
         dict = {"id": "materials.id=$id",
                 "course_id": "courses.id=$course_id",
                 "user_id": "users.id=$user_id",
                 "faculty": "courses.faculty=$faculty",
-                "search": """courses.code LIKE $search
-                          OR course_title LIKE $search
-                          OR materials.title LIKE $search
-                          OR tags LIKE $search
-                          OR courses.faculty LIKE $search"""}
-        clauses = " AND ".join([dict[key] for key in dict.keys() if args[key]])
-        query += " WHERE " + clauses if clauses else ""
+                "search": "materials_fts MATCH $search",
+                "tag": """materials.id IN (SELECT material_id FROM
+                    material_tags WHERE tag=$tag)"""}
+        clauses = [dict[key] for key in dict.keys() if args[key]]
+        # Materials waiting for a zip scan are only shown by id:
+        if not id:
+            clauses.append("materials.pending=0")
+
+        if order_by:
+            # Seek past the previous page instead of using OFFSET, so that
+            # every page costs the same:
+            column, _, direction = order_by.partition(" ")
+            direction = "desc" if direction.strip().lower() == "desc" else "asc"
+            op = "<" if direction == "desc" else ">"
+            query = query.replace("SELECT", "SELECT %s AS sort_key," % column, 1)
+            if after:
+                sort_key, after_id = after
+                clauses.append("%s %s= $sort_key AND (%s %s $sort_key OR "
+                    "materials.id %s $after_id)" % (column, op, column, op, op))
+            order_by = "%s %s" % (column, direction)
+            if column != "materials.id":
+                order_by += ", materials.id %s" % direction
+        query += " WHERE " + " AND ".join(clauses)
 
         if order_by:
             query += " ORDER BY %s" % order_by
         if limit:
             query += " LIMIT $limit"
-        return self.db.query(query, locals())
+        return web.iterbetter(self._merge_counters(self.query(query, locals())))
+
+    def _merge_counters(self, materials):
+        """Adds buffered counter increments to material rows. Counters that
+        weren't selected are skipped."""
+        for m in materials:
+            if "points" in m:
+                m.points += self.counters.pending("materials", "points", m.id)
+            if "comments" in m:
+                m.comments += self.counters.pending("materials", "comments", m.id)
+            if "user_points" in m:
+                m.user_points += self.counters.pending("users", "points", m.user_id)
+            yield m
 
     def like_material(self, material_id, user_id):
-        """Increases the points of a material by one, adds material's id to
-        user's "liked" column, so that it won't get liked twice by
-        the same user. Returns the material's points after the increase.
+        """Increases the points of a material and its owner by one and records
+        the like, so that the same user can't like a material twice and owners
+        can't like their own materials. Points are written through the counter
+        buffer. Returns the material's points after the increase, or None if
+        not liked.
 
         >>> db = DatabaseHandler(); uid = db.insert("users");
-        >>> mid = db.insert("materials", user_id=uid)
-        >>> db.like_material(mid, uid)
+        >>> uid2 = db.insert("users"); mid = db.insert("materials", user_id=uid)
+        >>> db.like_material(mid, uid2)
+        1
+        >>> db.like_material(mid, uid2), db.like_material(mid, uid)
+        (None, None)
+        >>> db.counters.flush(); db.select("users", id=uid)[0].points
         1
-        >>> db.select("materials", id=mid)[0].points
+        >>> m = db.select("materials", id=mid)[0]; m.hot > hot_score(0, 0, m.date_added)
+        True
+        >>> db.delete_material(mid); db.delete("users", id=uid)
+        1
+        >>> db.delete("users", id=uid2); db.select("likes", user_id=uid2).list()
+        []
+        """
+        args = {"material_id": material_id, "user_id": user_id}
+        liked = self.query("""INSERT OR IGNORE INTO likes(user_id, material_id)
+            SELECT $user_id, id FROM materials
+            WHERE id=$material_id AND user_id!=$user_id""", args)
+        if not liked:
+            return None
+        material = self.select("materials", "points, user_id", id=material_id)[0]
+        self.counters.add("users", "points", material.user_id)
+        return material.points + self.counters.add("materials", "points",
+            material_id)
+
+    def decay_hot(self, floor=HOT_FLOOR, batch_size=500):
+        """Recomputes the HOT scores that are still above floor, so that they
+        decay with age. Likes and comments update scores as they come, so
+        this only has to catch up with time. Each batch is a transaction of
+        its own. Returns the number of scores updated.
+
+        >>> db = DatabaseHandler(); id = db.insert("materials", date_added="2013-01-01")
+        >>> db.select("materials", id=id)[0].hot < HOT_FLOOR  # Scored on insert.
+        True
+        >>> db.update("materials", id, hot=1)
+        >>> db.decay_hot() >= 1, db.select("materials", id=id)[0].hot < HOT_FLOOR
+        (True, True)
+        >>> db.delete_material(id)
         1
-        >>> db.select("users", id=uid)[0].liked.split(" ")[0] == str(mid)
-        True
-        >>> db.delete("materials", id=mid); db.delete("users", id=uid)
-        """
-        # Update material's points:
-        material = self.select("materials", id=material_id)[0]
-        pts = material.points + 1
-        self.update("materials", id=material_id, points=pts)
-        # Update material's owner's points:
-        owner_pts = self.select("users", id=material.user_id)[0].points + 1
-        self.update("users", id=material.user_id, points=owner_pts)
-        # Update the user who liked the material:
-        liked = self.select("users", id=user_id)[0].liked
-        liked = liked + " " + str(material_id) if liked else str(material_id)
-        self.update("users", id=user_id, liked=liked)
-        return pts
+        """
+        ids = [row.id for row in self.query(
+            "SELECT id FROM materials WHERE hot > $floor", locals())]
+        for i in range(0, len(ids), batch_size):
+            with self.transaction():
+                for id in ids[i:i + batch_size]:
+                    self.query("""UPDATE materials SET hot=hot_score(points,
+                        comments, date_added) WHERE id=$id""", locals())
+                    self._invalidate(self.row_cache.invalidate_row,
+                                     "materials", id)
+        return len(ids)
+
+    def add_material_tags(self, material_id, tags):
+        """Indexes a material's space separated tags. Tag counts are kept up
+        to date by triggers."""
+        for tag in split_tags(tags):
+            self.query("""INSERT OR IGNORE INTO material_tags(material_id, tag)
+                VALUES($material_id, $tag)""", locals())
+
+    def get_tags(self, limit=50):
+        """Returns the most used tags and the number of materials each one has.
+
+        >>> db = DatabaseHandler(); id = db.insert("materials")
+        >>> db.add_material_tags(id, u"zzkaavat")
+        >>> u"zzkaavat" in [t.tag for t in db.get_tags(1000)]
+        True
+        >>> db.delete_material(id), db.select("tag_counts", tag=u"zzkaavat").list()
+        (1, [])
+        """
+        return self.query("""SELECT tag, count FROM tag_counts
+            ORDER BY count DESC LIMIT $limit""", locals())
 
     def delete_material(self, id):
-        """Deletes a material and its comments from database, reduces
-        owner's points accordingly."""
-        self.delete("comments", material_id=id)
-        material = self.select("materials", id=id)[0]
-        points, user_id = material.points, material.user_id
-        user_points = self.select("users", id=user_id)[0].points
-        self.update("users", id=user_id, points=(user_points - points))
-        self.delete("materials", id=id)
+        """Deletes a material, its comments and tags from database, reduces
+        owner's points accordingly. Returns the number of materials deleted,
+        which is 0 if a concurrent request deleted the material first.
+
+        >>> db = DatabaseHandler(); id = db.insert("materials")
+        >>> db.delete_material(id), db.delete_material(id)
+        (1, 0)
+        """
+        material = self.select("materials", id=id).list()
+        if not material:
+            return 0
+        material = material[0]
+        with self.transaction():
+            # The row is deleted first, so that concurrent deletes wait for
+            # the write lock and then find nothing to delete:
+            deleted = self.query("DELETE FROM materials WHERE id=$id",
+                locals())
+            if deleted:
+                self.delete("comments", material_id=id)
+                self.delete("likes", material_id=id)
+                self.delete("material_tags", material_id=id)
+        self._written("materials", [material], {})
+        if deleted:
+            points = material.points + self.counters.pending("materials",
+                "points", id)
+            self.counters.discard("materials", id)
+            if points:
+                self.counters.add("users", "points", material.user_id, -points)
+        return deleted
+
+    ### BLOBS ###
+
+    def reference_blob(self, sha256, size):
+        """Adds a reference to a stored file, returns its reference count.
+
+        >>> db = DatabaseHandler(); sha256 = "0" * 64
+        >>> db.reference_blob(sha256, 10), db.reference_blob(sha256, 10)
+        (1, 2)
+        >>> db.release_blob(sha256), db.release_blob(sha256)
+        (False, True)
+        """
+        self.query("""INSERT OR IGNORE INTO blobs(sha256, size)
+            VALUES($sha256, $size)""", locals())
+        self.query("UPDATE blobs SET refs=refs+1 WHERE sha256=$sha256",
+            locals())
+        return self.select("blobs", "refs", sha256=sha256)[0].refs
+
+    def release_blob(self, sha256):
+        """Removes a reference to a stored file. Returns True if the file
+        isn't referenced anymore and should be deleted."""
+        self.query("UPDATE blobs SET refs=refs-1 WHERE sha256=$sha256",
+            locals())
+        return bool(self.query("""DELETE FROM blobs
+            WHERE sha256=$sha256 AND refs<=0""", locals()))
+
+    ### MAIL ###
+
+    def enqueue_mail(self, sender, recipient, subject, message):
+        """Queues an email for the mail worker, returns the job's id."""
+        return self.insert("mail_jobs", sender=sender, recipient=recipient,
+            subject=subject, message=message, next_attempt=time.time())
+
+    def claim_mail_jobs(self, lease, limit=10):
+        """Claims due mail jobs, so that no other worker picks them up for
+        `lease` seconds. Returns the claimed jobs.
+
+        >>> db = DatabaseHandler(); id = db.enqueue_mail("a", "b", u"c", u"d")
+        >>> id in [job.id for job in db.claim_mail_jobs(60, limit=1000)]
+        True
+        >>> id in [job.id for job in db.claim_mail_jobs(60, limit=1000)]
+        False
+        >>> db.finish_mail_job(id); db.select("mail_jobs", id=id)[0].status
+        u'sent'
+        """
+        now = time.time()
+        jobs = self.query("""SELECT * FROM mail_jobs WHERE status='queued'
+            AND next_attempt <= $now ORDER BY next_attempt LIMIT $limit""",
+            locals()).list()
+        claimed = []
+        for job in jobs:
+            # Only claim the job if no one else got to it first:
+            if self.query("""UPDATE mail_jobs SET attempts=attempts+1,
+                next_attempt=$until WHERE id=$id AND next_attempt=$previous""",
+                {"until": now + lease, "id": job.id,
+                 "previous": job.next_attempt}):
+                job.attempts += 1
+                claimed.append(job)
+        return claimed
+
+    def finish_mail_job(self, id, error=None, retry_at=None):
+        """Marks a mail job sent or, if there was an error, queues it again to
+        be retried at `retry_at`. Without `retry_at` the job has failed."""
+        status = "queued" if retry_at else "failed"
+        if error is None:
+            status = "sent"
+        self.query("""UPDATE mail_jobs SET status=$status, last_error=$error,
+            next_attempt=$retry_at WHERE id=$id""", locals())
 
     ### COMMENTS ###
 
     def add_comment(self, content, user_id, material_id):
-        """Add a comment, increase the material's amount of comments by one."""
+        """Add a comment, increase the material's amount of comments by one.
+
+        >>> db = DatabaseHandler(); mid = db.insert("materials")
+        >>> db.add_comment(u"kommentti", None, mid)
+        1
+        >>> db.counters.flush(); db.select("materials", id=mid)[0].comments
+        1
+        >>> db.delete_material(mid)
+        1
+        """
         self.insert("comments", content=content, user_id=user_id,
             material_id=material_id)
-        comments = self.select("materials", id=material_id)[0].comments + 1
-        self.update("materials", material_id, comments=comments)
-        return comments
-
-    def get_comments(self, material_id):
-        """Returns a given material's comments."""
-        query = """SELECT id, content, user_id, material_id, date_added,
-                (SELECT name FROM users WHERE users.id = user_id) AS name
-                FROM comments WHERE material_id = $material_id
-                ORDER BY date_added LIMIT 100
-                """
-        return self.db.query(query, locals())
+        comments = self.select("materials", "comments", id=material_id)[0]
+        pending = self.counters.add("materials", "comments", material_id)
+        return comments.comments + pending
+
+    def get_comments(self, material_id, since=None):
+        """Returns a given material's comments, or only the ones added after
+        the comment whose id is since.
+
+        >>> db = DatabaseHandler(); uid = db.insert("users", name=u"u1")
+        >>> mid = db.insert("materials"); _ = db.add_comment(u"a", uid, mid)
+        >>> first = db.get_comments(mid)[0]; first.name
+        u'u1'
+        >>> _ = db.add_comment(u"b", uid, mid)
+        >>> [c.content for c in db.get_comments(mid, since=first.id)]
+        [u'b']
+        >>> db.delete_material(mid); db.delete("users", id=uid)
+        1
+        """
+        query = """SELECT comments.id, content, user_id, material_id,
+                comments.date_added, users.name FROM comments
+                LEFT JOIN users ON users.id = comments.user_id
+                WHERE material_id = $material_id"""
+        if since:
+            query += " AND comments.id > $since"
+        query += " ORDER BY comments.date_added, comments.id LIMIT 100"
+        return self.query(query, locals())
 
     ### INIT ###
 
-    def __init__(self):
-        """Initializes database tables if they don't already exist."""
+    def __init__(self, path=DATABASE):
+        """Initializes database tables if they don't already exist and applies
+        pending schema migrations."""
         try:
-            conn = sqlite3.connect("kurssit.db")
+            conn = connect(path)
             c = conn.cursor()
             c.executescript("""
                 CREATE TABLE IF NOT EXISTS users(
@@ -235,6 +1737,8 @@ class DatabaseHandler:
                     date_added   TEXT DEFAULT CURRENT_TIMESTAMP
                 );
             """)
+            conn.isolation_level = None  # Migrations manage transactions.
+            migrate(conn)
             conn.close()
 
         except Exception, e:
@@ -242,11 +1746,21 @@ class DatabaseHandler:
             import sys
             sys.exit()
 
-        self.db = web.database(dbn="sqlite", db="kurssit.db")
-        self.insert = self.db.insert
+        self.db = SqliteDB(path)
+        self.row_cache = RowCache()
+        self.counters = CounterBuffer(connect(path, check_same_thread=False),
+            derived={"materials": HOT_UPDATE}, flushed=self._counters_flushed)
+        self.path = path
+        self.local = threading.local()
+        self.query_timings = self.db.timings  # Also of the session store.
+        self._load_course_index()
 
 if __name__ == "__main__":
+    import sys
     db = DatabaseHandler()
+    # Run "python models.py explain" to check the hot queries' plans:
+    if sys.argv[1:] == ["explain"]:
+        db.print_query_plans()
 
 
 def doctest():